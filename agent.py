@@ -2,10 +2,23 @@ from __future__ import annotations
 
 import openai
 from openai import OpenAI
-from typing import Generator, Literal
+import httpx
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Generator, Literal, TypeVar, TYPE_CHECKING
 from enum import Enum
+from pydantic import BaseModel, ValidationError
+from threading import Lock
+from time import perf_counter
 import os
 
+if TYPE_CHECKING:
+    from cache import ResponseCache
+    from instrument import Metrics
+
 
 import pdb
 
@@ -23,11 +36,292 @@ class Message(dict):
         super().__init__(role=role.value, content=content)
 
 
-# TODO: make this an abstract class, and have a separate class for each model
+def message_key(model: str, messages: list[Message]) -> str:
+    """Hash of the model and messages. Whitespace differences at the ends of lines/messages are ignored"""
+    normalized = [
+        {
+            'role': m['role'],
+            'content': '\n'.join(line.rstrip() for line in m['content'].strip().splitlines())
+        }
+        for m in messages
+    ]
+    payload = json.dumps({'model': model, 'messages': normalized}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def match_option(text: str, options: list[str]) -> str | None:
+    """
+    The option that a (possibly partial) answer can only be, or the answer itself if it can't be any option.
+    None if the answer is still ambiguous. Partial answers shorter than 3 characters don't select an option on their own
+    """
+    answer = text.strip()
+    if not answer:
+        return None
+    candidates = [option for option in options if option.startswith(answer)]
+    if not candidates:
+        return answer
+    if answer in candidates and len(candidates) == 1:
+        return answer
+    if len(candidates) == 1 and len(answer) >= 3:
+        return candidates[0]
+    return None
+
+
+def parse_json_object(text: str) -> dict:
+    """The JSON object in a response, ignoring any surrounding text or markdown code fences"""
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError('no JSON object in response')
+    obj = json.loads(text[start:end + 1])
+    if not isinstance(obj, dict):
+        raise ValueError('response is not a JSON object')
+    return obj
+
+
+M = TypeVar('M', bound=BaseModel)
+
+
+def validate_fields(schema: type[M], data: dict) -> tuple[M | None, dict[str, str]]:
+    """Validate data against schema, returning (the model or None, errors by field name)"""
+    try:
+        return schema.model_validate(data), {}
+    except ValidationError as e:
+        errors = {}
+        for error in e.errors():
+            field = str(error['loc'][0]) if error['loc'] else '__root__'
+            errors.setdefault(field, error['msg'])
+        return None, errors
+
+
+def estimate_tokens(text: str) -> int:
+    """rough token count of text (about 4 characters per token), for when the API doesn't report usage"""
+    return len(text) // 4
+
+
+@dataclass
+class Completion:
+    content: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class Backend(ABC):
+    """Where an Agent's requests go: a model API, or e.g. a recording of previous responses"""
+
+    @abstractmethod
+    def complete(self, model: str, messages: list[Message], timeout: float | None) -> Completion:
+        ...
+
+    @abstractmethod
+    def stream(self, model: str, messages: list[Message], timeout: float | None, max_tokens: int | None = None) -> Generator[str, None, Completion | None]:
+        """
+        Yields the response text as it arrives. If the stream is read to the end, it returns the Completion with the
+        token usage reported by the API, or None if the backend doesn't report usage for streams
+        """
+        ...
+
+    def cached(self, model: str, messages: list[Message], response: str):
+        """Called when the Agent answers a request from its response cache, without going through the backend"""
+        pass
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend(Backend):
+    """The OpenAI chat completions API (or any compatible endpoint at base_url)"""
+
+    def __init__(self, base_url: str | None = None, timeout: float | None = None, max_connections: int = 32, stream_usage: bool = True):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        # ask for token usage at the end of streams. Set to False for compatible endpoints that reject stream_options
+        self.stream_usage = stream_usage
+
+        # created on first use, so that set_openai_key() may be called after constructing the agent
+        self._client: OpenAI | None = None
+        self._client_lock = Lock()
+
+    @property
+    def client(self) -> OpenAI:
+        """Long-lived client shared by every call (and thread), so HTTP connections are pooled and kept alive"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = OpenAI(
+                        api_key=openai.api_key,  # None falls back to the OPENAI_API_KEY environment variable
+                        base_url=self.base_url,
+                        timeout=self.timeout,
+                        http_client=openai.DefaultHttpxClient(
+                            limits=httpx.Limits(
+                                max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections,
+                                keepalive_expiry=60.0,
+                            )
+                        ),
+                    )
+        return self._client
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def complete(self, model: str, messages: list[Message], timeout: float | None) -> Completion:
+        completion = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=timeout
+        )
+        usage = completion.usage
+        return Completion(
+            completion.choices[0].message.content or '',
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+        )
+
+    def stream(self, model: str, messages: list[Message], timeout: float | None, max_tokens: int | None = None) -> Generator[str, None, Completion | None]:
+        gen = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=timeout,
+            stream=True,
+            **({'max_tokens': max_tokens} if max_tokens is not None else {}),
+            **({'stream_options': {'include_usage': True}} if self.stream_usage else {})
+        )
+        chunks = []
+        usage = None
+        try:
+            for chunk in gen:
+                # the usage comes in a final chunk with no choices
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+                # e.g. chunks with no choices. The yield stays outside the try, so that closing the generator early works
+                try:
+                    content = chunk.choices[0].delta.content
+                except (IndexError, AttributeError):
+                    continue
+                if content:
+                    chunks.append(content)
+                    yield content
+        finally:
+            # closing the response lets the connection go back to the pool, even if the caller stops reading early
+            gen.close()
+        if usage is None:
+            return None
+        return Completion(''.join(chunks), prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+class RecordingBackend(Backend):
+    """
+    Passes requests through to another backend, appending every request/response pair to a JSONL file at `path`,
+    for replaying later with ReplayBackend. Requests the Agent answers from its response cache are recorded too, so
+    the recording replays the whole session without the cache
+    """
+
+    def __init__(self, backend: Backend, path: str | Path):
+        self.backend = backend
+        self.path = Path(path)
+        self._lock = Lock()
+
+    def _record(self, model: str, messages: list[Message], response: str):
+        line = json.dumps({'key': message_key(model, messages), 'model': model, 'messages': messages, 'response': response}, ensure_ascii=False)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def cached(self, model: str, messages: list[Message], response: str):
+        self._record(model, messages, response)
+
+    def complete(self, model: str, messages: list[Message], timeout: float | None) -> Completion:
+        completion = self.backend.complete(model, messages, timeout)
+        self._record(model, messages, completion.content)
+        return completion
+
+    def stream(self, model: str, messages: list[Message], timeout: float | None, max_tokens: int | None = None) -> Generator[str, None, Completion | None]:
+        # records whatever was streamed, even if the caller stopped reading early
+        chunks = []
+        stream = self.backend.stream(model, messages, timeout, max_tokens)
+        try:
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as stop:
+                    return stop.value
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+            self._record(model, messages, ''.join(chunks))
+
+    def close(self):
+        self.backend.close()
+
+
+class ReplayBackend(Backend):
+    """
+    Serves the responses recorded by RecordingBackend at `path`, without any network calls.
+    Requests that were made more than once get their recorded responses in order (repeating the last one).
+    Requests that weren't recorded go to the `fallback` backend if given, and otherwise raise a KeyError
+    """
+
+    def __init__(self, path: str | Path, fallback: Backend | None = None):
+        self.fallback = fallback
+        self._responses: dict[str, list[str]] = {}
+        self._served: dict[str, int] = {}
+        self._lock = Lock()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._responses.setdefault(entry['key'], []).append(entry['response'])
+
+    def _lookup(self, model: str, messages: list[Message]) -> str | None:
+        key = message_key(model, messages)
+        with self._lock:
+            responses = self._responses.get(key)
+            if responses is None:
+                return None
+            i = self._served.get(key, 0)
+            self._served[key] = i + 1
+            return responses[min(i, len(responses) - 1)]
+
+    def complete(self, model: str, messages: list[Message], timeout: float | None) -> Completion:
+        response = self._lookup(model, messages)
+        if response is not None:
+            return Completion(response)
+        if self.fallback is not None:
+            return self.fallback.complete(model, messages, timeout)
+        raise KeyError(f'No recorded response for request: {messages[-1]["content"][:200]!r}')
+
+    def stream(self, model: str, messages: list[Message], timeout: float | None, max_tokens: int | None = None) -> Generator[str, None, Completion | None]:
+        response = self._lookup(model, messages)
+        if response is not None:
+            yield response
+        elif self.fallback is not None:
+            return (yield from self.fallback.stream(model, messages, timeout, max_tokens))
+        else:
+            raise KeyError(f'No recorded response for request: {messages[-1]["content"][:200]!r}')
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+
+
 class Agent:
-    def __init__(self, model: Literal['gpt-4', 'gpt-4-turbo-preview'], timeout=None):
+    """
+    Sends prompts to a model via a Backend: by default the OpenAI API, but e.g. a RecordingBackend or ReplayBackend
+    can be given to record a session and re-run it later without any network calls
+    """
+
+    def __init__(self, model: Literal['gpt-4', 'gpt-4-turbo-preview'], timeout=None, cache: ResponseCache | None = None, base_url: str | None = None, max_connections: int = 32, metrics: Metrics | None = None, backend: Backend | None = None):
         self.model = model
         self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics
+        self.backend = backend if backend is not None else OpenAIBackend(base_url, timeout, max_connections)
+
+    def close(self):
+        self.backend.close()
 
     def oneshot_sync(self, prompt: str, query: str) -> str:
         return self.multishot_sync([
@@ -42,32 +336,132 @@ class Agent:
         ])
 
     def multishot_sync(self, messages: list[Message]) -> str:
-        # client = OpenAI()
-        # completion = client.chat.completions.create(
-        #     model=self.model,
-        #     messages=messages,
-        #     timeout=self.timeout
-        # )
-        # result = completion.choices[0].message.content
-        # return result
-        gen = self.multishot_streaming(messages)
-        return ''.join([*gen])
-
-    def multishot_streaming(self, messages: list[Message]) -> Generator[str, None, None]:
-        client = OpenAI()
-        gen = client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            timeout=self.timeout,
-            stream=True
-        )
-        for chunk in gen:
+        if self.cache is not None:
+            cached = self.cache.get(self.model, messages)
+            if self.metrics is not None:
+                self.metrics.record_cache(hit=cached is not None)
+            if cached is not None:
+                self.backend.cached(self.model, messages, cached)
+                return cached
+
+        start = perf_counter()
+        completion = self.backend.complete(self.model, messages, self.timeout)
+        if self.metrics is not None:
+            self.metrics.record_call(perf_counter() - start, completion.prompt_tokens, completion.completion_tokens)
+
+        if self.cache is not None:
+            self.cache.put(self.model, messages, completion.content)
+        return completion.content
+
+    def multishot_streaming(self, messages: list[Message], max_tokens: int | None = None) -> Generator[str, None, None]:
+        # the latency is to the last chunk read. If the stream is closed early (or the backend doesn't report usage for
+        # streams), the tokens are estimated from the text sent and received, and recorded as estimates
+        start = perf_counter()
+        stream = self.backend.stream(self.model, messages, self.timeout, max_tokens)
+        text = ''
+        completion = None
+        try:
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as stop:
+                    completion = stop.value
+                    break
+                text += chunk
+                yield chunk
+        finally:
+            stream.close()
+            if self.metrics is not None:
+                if completion is not None:
+                    self.metrics.record_call(perf_counter() - start, completion.prompt_tokens, completion.completion_tokens)
+                else:
+                    self.metrics.record_call(
+                        perf_counter() - start,
+                        estimate_tokens(''.join(m['content'] for m in messages)),
+                        estimate_tokens(text),
+                        estimated=True
+                    )
+
+    def choose(self, messages: list[Message], options: list[str], max_tokens: int = 8) -> str:
+        """
+        Ask for one of the given options. The answer is streamed, and the stream is closed as soon as the text so far
+        can only be one of the options (or can't be any of them), rather than waiting for the model to finish.
+        Returns the option, or the text received if it doesn't match any option
+        """
+        if self.cache is not None:
+            cached = self.cache.get(self.model, messages)
+            if self.metrics is not None:
+                self.metrics.record_cache(hit=cached is not None)
+            if cached is not None:
+                self.backend.cached(self.model, messages, cached)
+                return cached
+
+        text = ''
+        result = None
+        stream = self.multishot_streaming(messages, max_tokens=max_tokens)
+        try:
+            for chunk in stream:
+                text += chunk
+                result = match_option(text, options)
+                if result is not None:
+                    break
+        finally:
+            stream.close()
+        result = result or text.strip()
+
+        if self.cache is not None:
+            self.cache.put(self.model, messages, result)
+        return result
+
+    def structured(self, messages: list[Message], schema: type[M], keys: list[str], max_retries: int = 2) -> dict[str, M]:
+        """
+        Ask for a JSON object with an entry per key (e.g. per column), each validated against the pydantic model `schema`.
+        Entries with missing or invalid fields are asked for again, only those fields and with the validation errors,
+        up to `max_retries` times. Returns the valid entries; keys that still fail are left out
+        """
+        messages = [*messages, Message(role=Role.user, content=f'''\
+Without any other comments, respond with a JSON object with the keys {json.dumps(keys)}, where each value is an object matching this JSON schema:
+{json.dumps(schema.model_json_schema())}\
+''')]
+        data: dict[str, dict] = {key: {} for key in keys}
+        results: dict[str, M] = {}
+        for attempt in range(max_retries + 1):
+            response = self.multishot_sync(messages)
             try:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
-            except:
-                pass
+                obj = parse_json_object(response)
+            except ValueError as e:
+                obj, problem = {}, f'The response could not be parsed ({e}).'
+            else:
+                problem = 'Some of the values were missing or invalid:'
+
+            errors: dict[str, dict[str, str]] = {}
+            for key in keys:
+                if key in results:
+                    continue
+                value = obj.get(key)
+                if isinstance(value, dict):
+                    data[key].update(value)
+                result, key_errors = validate_fields(schema, data[key])
+                if result is not None:
+                    results[key] = result
+                else:
+                    # keep only the valid fields, so the retry asks for the rest
+                    data[key] = {field: v for field, v in data[key].items() if field not in key_errors}
+                    errors[key] = key_errors
+
+            if not errors or attempt == max_retries:
+                break
+            errors_str = '\n'.join(f'- {json.dumps(key)}.{field}: {error}' for key, key_errors in errors.items() for field, error in key_errors.items())
+            messages = [
+                *messages,
+                Message(role=Role.assistant, content=response),
+                Message(role=Role.user, content=f'''\
+{problem}
+{errors_str}
+Without any other comments, respond with a JSON object containing only corrected values for these keys and fields: {json.dumps({key: list(key_errors) for key, key_errors in errors.items()})}\
+'''),
+            ]
+        return results
 
 
 def set_openai_key(api_key: str | None = None):
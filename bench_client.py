@@ -0,0 +1,62 @@
+"""
+Microbenchmark of the per-call overhead of the Agent's OpenAI client, measured against a local mock endpoint.
+
+Compares the old approach (a new OpenAI() client per call, streaming and joining the chunks) with the Agent's
+pooled keep-alive client and non-streaming sync path.
+
+Usage:
+    python bench_client.py --calls 200
+"""
+from __future__ import annotations
+
+from agent import Agent, Message, Role, set_openai_key
+from mock_llm import MockLLMServer
+from openai import OpenAI
+from time import perf_counter
+
+
+def fresh_client_streaming(base_url: str, model: str, messages: list[Message]) -> str:
+    client = OpenAI(api_key='mock', base_url=base_url)
+    gen = client.chat.completions.create(model=model, messages=messages, stream=True)
+    return ''.join([chunk.choices[0].delta.content or '' for chunk in gen if chunk.choices])
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--calls', action='store', type=int, default=200)
+    args = parser.parse_args()
+
+    messages = [
+        Message(Role.system, 'You are a helpful assistant.'),
+        Message(Role.user, 'Please select one of the following options: DATE, GEO, FEATURE, or UNSURE.'),
+    ]
+
+    with MockLLMServer(lambda messages: 'FEATURE') as server:
+        set_openai_key('mock')
+        agent = Agent(model='gpt-4', base_url=server.base_url)
+
+        # warm up both paths so imports and the first connection aren't counted
+        fresh_client_streaming(server.base_url, agent.model, messages)
+        agent.multishot_sync(messages)
+
+        start = perf_counter()
+        for _ in range(args.calls):
+            fresh_client_streaming(server.base_url, agent.model, messages)
+        fresh_time = perf_counter() - start
+
+        start = perf_counter()
+        for _ in range(args.calls):
+            agent.multishot_sync(messages)
+        pooled_time = perf_counter() - start
+
+        agent.close()
+
+    print(f'fresh client + streaming: {fresh_time / args.calls * 1000:.2f} ms/call')
+    print(f'pooled client + sync:     {pooled_time / args.calls * 1000:.2f} ms/call')
+    print(f'speedup: {fresh_time / pooled_time:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Offline end-to-end benchmark of the annotation pipeline, run against a local mock LLM server.
+
+Generates synthetic CSV, XLSX and NetCDF datasets of varying width and length, annotates each one (in its own process,
+so peak memory is measured per dataset) with `handle_csv`/`handle_xlsx`/`handle_netcdf`, and reports throughput,
+LLM calls per column and peak RSS. Results can be saved and compared against a previous run to catch regressions.
+
+Usage:
+    python benchmark.py --latency 0.2 --jitter 0.1 --output bench.json
+    python benchmark.py --latency 0.2 --jitter 0.1 --baseline bench.json
+    python benchmark.py --kinds nc --large --max-rss 512
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing as mp
+import resource
+import sys
+import tempfile
+from dataclasses import dataclass, asdict
+from multiprocessing.connection import Connection
+from pathlib import Path
+from time import perf_counter
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from agent import Agent, set_openai_key
+from instrument import Metrics
+from iso_codes import ISO3_CODES
+from meta import Meta
+from mock_llm import MockLLMServer, annotation_responder
+
+
+DatasetKind = Literal['csv', 'xlsx', 'nc']
+
+
+@dataclass
+class DatasetSpec:
+    kind: DatasetKind
+    rows: int
+    cols: int
+
+    @property
+    def name(self) -> str:
+        return f'{self.kind}_{self.rows}x{self.cols}'
+
+
+# for NetCDF, rows is the length of the time axis and cols is the number of data variables (on a 1 degree grid)
+DEFAULT_SPECS = [
+    DatasetSpec('csv', 1_000, 8),
+    DatasetSpec('csv', 100_000, 8),
+    DatasetSpec('csv', 10_000, 40),
+    DatasetSpec('xlsx', 1_000, 8),
+    DatasetSpec('xlsx', 20_000, 20),
+    DatasetSpec('nc', 24, 2),
+    DatasetSpec('nc', 120, 8),
+]
+
+# about 750MB on disk, bigger than the stats memory limit of handle_netcdf, to check that it's scanned without being held
+# in memory (see --large)
+LARGE_SPECS = [
+    DatasetSpec('nc', 120, 24),
+]
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    kind: DatasetKind
+    columns: int
+    seconds: float
+    llm_calls: int
+    cache_hits: int
+    prompt_tokens: int
+    # how many of prompt_tokens were estimated, for streamed calls that reported no usage
+    estimated_prompt_tokens: int
+    peak_rss_mb: float
+
+    @property
+    def calls_per_column(self) -> float:
+        return self.llm_calls / self.columns if self.columns else 0.0
+
+
+def synthetic_frame(rows: int, cols: int, seed: int = 0) -> pd.DataFrame:
+    """a table with date, lat/lon and country columns, then a mix of float, int and categorical feature columns"""
+    rng = np.random.default_rng(seed)
+    columns = {
+        'event_date': pd.Timestamp('2000-01-01') + pd.to_timedelta(rng.integers(0, 365 * 20, rows), unit='D'),
+        'latitude': rng.uniform(-60, 60, rows).round(5),
+        'longitude': rng.uniform(-180, 180, rows).round(5),
+        'country': rng.choice(sorted(ISO3_CODES), rows),
+    }
+    columns['event_date'] = columns['event_date'].strftime('%Y-%m-%d')
+    for i in range(max(0, cols - len(columns))):
+        if i % 3 == 0:
+            columns[f'measurement_{i}'] = rng.normal(100, 25, rows).round(3)
+        elif i % 3 == 1:
+            columns[f'count_{i}'] = rng.poisson(20, rows)
+        else:
+            columns[f'category_{i}'] = rng.choice(['low', 'medium', 'high', 'extreme'], rows)
+    return pd.DataFrame(columns).iloc[:, :cols]
+
+
+def synthetic_dataset(times: int, n_vars: int, seed: int = 0) -> xr.Dataset:
+    """a CF-style gridded dataset on a 1 degree global grid, half of whose variables lack CF attributes"""
+    rng = np.random.default_rng(seed)
+    lat = np.arange(-89.5, 90, 1.0)
+    lon = np.arange(-179.5, 180, 1.0)
+    data_vars = {}
+    for i in range(n_vars):
+        values = rng.random((times, lat.size, lon.size), dtype=np.float32)
+        attrs = {'units': 'K', 'long_name': f'Synthetic field {i}'} if i % 2 == 0 else {}
+        data_vars[f'var_{i}'] = (('time', 'lat', 'lon'), values, attrs)
+    return xr.Dataset(
+        data_vars,
+        coords={
+            'time': ('time', pd.date_range('2000-01-01', periods=times, freq='MS'), {'standard_name': 'time'}),
+            'lat': ('lat', lat, {'standard_name': 'latitude', 'units': 'degrees_north'}),
+            'lon': ('lon', lon, {'standard_name': 'longitude', 'units': 'degrees_east'}),
+        },
+    )
+
+
+def generate(spec: DatasetSpec, directory: Path) -> tuple[Path, int]:
+    """write the dataset for spec into directory. Returns its path and number of columns/variables"""
+    path = directory / f'{spec.name}.{spec.kind}'
+    if spec.kind == 'nc':
+        data = synthetic_dataset(spec.rows, spec.cols)
+        data.to_netcdf(path, encoding={name: {'chunksizes': (1, 180, 360)} for name in data.data_vars})
+        return path, len(data.variables)
+    df = synthetic_frame(spec.rows, spec.cols)
+    if spec.kind == 'csv':
+        df.to_csv(path, index=False)
+    else:
+        df.to_excel(path, index=False)
+    return path, len(df.columns)
+
+
+def peak_rss_mb() -> float:
+    """peak resident memory of this process in MB"""
+    status = Path('/proc/self/status')
+    if status.exists():
+        # Linux carries ru_maxrss over from the parent process, even across exec, but VmHWM starts afresh
+        for line in status.read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def _run_one(spec: DatasetSpec, path: Path, base_url: str, max_workers: int, conn: Connection):
+    """Runs in a child process: annotate one dataset and report (seconds, metrics totals, peak RSS in MB)"""
+    from process_df import handle_csv, handle_xlsx
+    from process_xr import handle_netcdf
+
+    set_openai_key('mock')
+    metrics = Metrics()
+    agent = Agent(model='gpt-4', base_url=base_url, metrics=metrics)
+    meta = Meta(path, spec.name, f'Synthetic {spec.kind} dataset for benchmarking')
+    start = perf_counter()
+    if spec.kind == 'csv':
+        handle_csv(meta, agent, max_workers=max_workers)
+    elif spec.kind == 'xlsx':
+        handle_xlsx(meta, agent, max_workers=max_workers)
+    else:
+        handle_netcdf(meta, agent, max_workers=max_workers, stats_cache=None)
+    seconds = perf_counter() - start
+    agent.close()
+    conn.send((seconds, metrics.report()['totals'], peak_rss_mb()))
+    conn.close()
+
+
+def run_benchmark(specs: list[DatasetSpec], latency: float = 0.2, jitter: float = 0.1, max_workers: int = 8) -> list[BenchmarkResult]:
+    results = []
+    # spawned rather than forked, so the peak RSS is the child's own, not this process's (e.g. after generating a large file)
+    ctx = mp.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp, MockLLMServer(annotation_responder, latency=latency, jitter=jitter) as server:
+        for spec in specs:
+            path, columns = generate(spec, Path(tmp))
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_run_one, args=(spec, path, server.base_url, max_workers, send_conn))
+            proc.start()
+            send_conn.close()
+            try:
+                seconds, totals, peak_rss = recv_conn.recv()
+            except EOFError:
+                raise RuntimeError(f'benchmark of {spec.name} exited with code {proc.exitcode}') from None
+            finally:
+                proc.join()
+            results.append(BenchmarkResult(
+                name=spec.name,
+                kind=spec.kind,
+                columns=columns,
+                seconds=seconds,
+                llm_calls=totals['llm_calls'],
+                cache_hits=totals['cache_hits'],
+                prompt_tokens=totals['prompt_tokens'],
+                estimated_prompt_tokens=totals['estimated_prompt_tokens'],
+                peak_rss_mb=peak_rss,
+            ))
+    return results
+
+
+def summarize(results: list[BenchmarkResult]) -> dict:
+    total_seconds = sum(r.seconds for r in results)
+    return {
+        'datasets_per_minute': len(results) / total_seconds * 60 if total_seconds else 0.0,
+        'results': [{**asdict(r), 'calls_per_column': r.calls_per_column} for r in results],
+    }
+
+
+def print_report(summary: dict):
+    print(f'{"dataset":<18} {"columns":>7} {"seconds":>8} {"calls":>6} {"calls/col":>9} {"tokens":>9} {"peak RSS":>9}')
+    for r in summary['results']:
+        print(f'{r["name"]:<18} {r["columns"]:>7} {r["seconds"]:>8.2f} {r["llm_calls"]:>6} {r["calls_per_column"]:>9.2f} {r["prompt_tokens"]:>8}{"~" if r["estimated_prompt_tokens"] else " "} {r["peak_rss_mb"]:>7.0f}MB')
+    if any(r['estimated_prompt_tokens'] for r in summary['results']):
+        print('~ includes estimated tokens, from streamed calls that reported no usage')
+    print(f'throughput: {summary["datasets_per_minute"]:.1f} datasets/minute')
+
+
+def memory_regressions(summary: dict, names: list[str], max_rss_mb: float) -> list[str]:
+    """the named datasets whose peak RSS exceeded max_rss_mb"""
+    return [
+        f'{r["name"]}: peak RSS of {r["peak_rss_mb"]:.0f}MB exceeds {max_rss_mb:.0f}MB'
+        for r in summary['results'] if r['name'] in names and r['peak_rss_mb'] > max_rss_mb
+    ]
+
+
+def compare(summary: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """regressions of summary relative to baseline: lower throughput, more calls per column, or higher peak memory"""
+    regressions = []
+    if summary['datasets_per_minute'] < baseline['datasets_per_minute'] * (1 - tolerance):
+        regressions.append(f'throughput dropped from {baseline["datasets_per_minute"]:.1f} to {summary["datasets_per_minute"]:.1f} datasets/minute')
+    previous = {r['name']: r for r in baseline['results']}
+    for r in summary['results']:
+        if r['name'] not in previous:
+            continue
+        before = previous[r['name']]
+        if r['calls_per_column'] > before['calls_per_column'] + 1e-9:
+            regressions.append(f'{r["name"]}: calls per column rose from {before["calls_per_column"]:.2f} to {r["calls_per_column"]:.2f}')
+        if r['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f'{r["name"]}: peak RSS rose from {before["peak_rss_mb"]:.0f}MB to {r["peak_rss_mb"]:.0f}MB')
+    return regressions
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--latency', action='store', type=float, default=0.2, help='mean simulated LLM latency in seconds')
+    parser.add_argument('--jitter', action='store', type=float, default=0.1, help='maximum random variation of the latency in seconds')
+    parser.add_argument('--max-workers', action='store', type=int, default=8, help='number of concurrent LLM calls per annotation pass')
+    parser.add_argument('--kinds', action='store', nargs='+', choices=['csv', 'xlsx', 'nc'], default=['csv', 'xlsx', 'nc'])
+    parser.add_argument('--output', action='store', type=Path, default=None, help='save the results as JSON')
+    parser.add_argument('--baseline', action='store', type=Path, default=None, help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', action='store', type=float, default=0.2, help='relative slowdown/memory growth allowed before failing')
+    parser.add_argument('--large', action='store_true', help='also annotate the large datasets, failing if their peak RSS exceeds --max-rss')
+    parser.add_argument('--max-rss', action='store', type=float, default=512, help='peak RSS in MB allowed for the large datasets')
+    args = parser.parse_args()
+
+    large = [spec for spec in LARGE_SPECS if spec.kind in args.kinds] if args.large else []
+    specs = [spec for spec in DEFAULT_SPECS if spec.kind in args.kinds] + large
+    summary = summarize(run_benchmark(specs, latency=args.latency, jitter=args.jitter, max_workers=args.max_workers))
+    print_report(summary)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(summary, indent=2))
+    regressions = memory_regressions(summary, [spec.name for spec in large], args.max_rss)
+    if args.baseline is not None:
+        regressions += compare(summary, json.loads(args.baseline.read_text()), args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+
+from agent import Message, message_key
+
+
+class ResponseCache:
+    """
+    Persistent content-addressed cache of LLM responses, stored in a local SQLite file.
+
+    Entries are keyed by the model name plus the normalized list of messages sent to it. The cache holds at most
+    `max_entries` responses, evicting the least recently used ones first, and optionally expires entries older
+    than `ttl` seconds.
+    """
+
+    def __init__(self, path: str | Path = '.llm_cache.sqlite', max_entries: int = 100_000, ttl: float | None = None):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # a single connection shared between threads, serialized by the lock.
+        # WAL mode and a busy timeout let several processes share the same cache file
+        self._lock = Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute('''\
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+)''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    @staticmethod
+    def make_key(model: str, messages: list[Message]) -> str:
+        return message_key(model, messages)
+
+    def get(self, model: str, messages: list[Message]) -> str | None:
+        key = self.make_key(model, messages)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, model: str, messages: list[Message], response: str):
+        key = self.make_key(model, messages)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, model, response, now, now)
+            )
+            # evict the least recently used entries over the limit
+            count, = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM responses')
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            count, = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()
+        return count
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import json
+import multiprocessing as mp
+import re
+import traceback
+from dataclasses import dataclass
+from multiprocessing.connection import Connection, wait
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Literal
+
+from agent import Agent
+from cache import ResponseCache
+from fingerprint import AnnotationStore, save_signatures
+from instrument import Metrics
+from loaders import SamplingMethod
+from meta import Meta
+from MetadataSchema import AnnotationSchema, MetaModel
+from process_df import handle_csv, handle_xlsx, table_signatures
+from process_xr import handle_netcdf, handle_netcdf_collection, handle_geotiff
+
+
+def annotate_file(
+    meta: Meta,
+    agent: Agent,
+    max_workers: int = 1,
+    batch_size: int | None = None,
+    heuristic_threshold: float | None = 0.9,
+    sample_rows: int | None = 10_000,
+    sampling: SamplingMethod = 'head',
+    store: AnnotationStore | None = None,
+    flat_taxonomy: bool = False,
+    previous: AnnotationSchema | MetaModel | None = None,
+    previous_signatures: dict[str, str] | None = None,
+) -> AnnotationSchema | dict[Path, AnnotationSchema]:
+    """
+    Annotate a single dataset, dispatching on its file type.
+    A NetCDF path with glob characters (e.g. data/*.nc) is annotated as a collection of files, returning the annotations
+    per file (see `handle_netcdf_collection`).
+    For tabular files, `previous` annotations of the dataset limit the LLM passes to new or changed columns, found by
+    comparing against the `previous_signatures` saved with them (see `table_signatures`) if given
+    """
+    suffix = meta.path.suffix
+    if suffix == '.csv':
+        return handle_csv(meta, agent, max_workers=max_workers, batch_size=batch_size,
+                          sample_rows=sample_rows, sampling=sampling, heuristic_threshold=heuristic_threshold,
+                          store=store, flat_taxonomy=flat_taxonomy, previous=previous, previous_signatures=previous_signatures)
+    if suffix == '.xlsx':
+        return handle_xlsx(meta, agent, max_workers=max_workers, batch_size=batch_size,
+                           sample_rows=sample_rows, heuristic_threshold=heuristic_threshold, store=store,
+                           flat_taxonomy=flat_taxonomy, previous=previous, previous_signatures=previous_signatures)
+    if suffix == '.nc' and is_glob(meta.path):
+        return handle_netcdf_collection(meta, agent, max_workers=max_workers)
+    if suffix == '.nc':
+        return handle_netcdf(meta, agent, max_workers=max_workers)
+    if suffix == '.tif' or suffix == '.tiff':
+        return handle_geotiff(meta, agent, max_workers=max_workers)
+    raise ValueError(f'Unhandled file type: {suffix}')
+
+
+def is_glob(path: Path) -> bool:
+    """whether the path is a glob pattern rather than a single file"""
+    return any(char in str(path) for char in '*?[')
+
+
+def serialize(annotations: AnnotationSchema | dict[Path, AnnotationSchema]) -> str:
+    """JSON of the result of `annotate_file`. A collection's annotations are keyed by file path"""
+    if isinstance(annotations, dict):
+        return json.dumps({str(path): a.model_dump(mode='json') for path, a in annotations.items()}, indent=2)
+    return annotations.model_dump_json(indent=2)
+
+
+def shorten_description(meta: Meta, agent: Agent) -> str:
+    desc = agent.oneshot_sync('You are a helpful assistant.', f'''\
+I have a dataset called "{meta.name}" With the following description:
+"""
+{meta.description}
+"""
+I would like to ensure that it is just a simple description purely about the data without any other superfluous information. Things to remove include contact info, bibliographies, URLs, etc. If there is a lot of superfluous information, could you pare it down to just the key details? Output only the new description without any other comments. If there are not superfluous details, output only the original unmodified description.\
+''')
+    return desc
+
+
+@dataclass
+class CatalogResult:
+    meta: Meta
+    status: Literal['done', 'failed', 'timeout']
+    output: Path | None
+    seconds: float
+    error: str | None = None
+
+
+def output_path(meta: Meta, output_dir: Path) -> Path:
+    # glob characters of a collection's pattern are replaced, e.g. *.nc -> _.nc.json
+    name = re.sub(r'[*?\[\]]', '_', meta.path.name)
+    return output_dir / f'{name}.json'
+
+
+def _annotate_worker(meta: Meta, output: Path, agent_options: dict[str, Any], annotate_options: dict[str, Any], conn: Connection):
+    """
+    Runs in a child process. Annotates one dataset, writes the schema to output, and reports back over conn.
+    For tabular datasets, the column signatures are written next to the output (.signatures.json), for later refreshes.
+    The run's metrics are written next to the output as a JSON report (.metrics.json) and a Prometheus textfile (.prom)
+    """
+    metrics = Metrics()
+    try:
+        cache_path = agent_options.pop('cache_path', None)
+        agent = Agent(**agent_options, cache=ResponseCache(cache_path) if cache_path is not None else None, metrics=metrics)
+        if len(meta.description) > 1000:
+            with metrics.stage('shorten description'):
+                meta.description = shorten_description(meta, agent)
+        annotations = annotate_file(meta, agent, **annotate_options)
+        output.write_text(serialize(annotations))
+        if meta.path.suffix in ('.csv', '.xlsx'):
+            save_signatures(output, table_signatures(meta, annotate_options.get('sample_rows', 10_000), annotate_options.get('sampling', 'head')))
+        conn.send(None)
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+        metrics.write_json(output.with_suffix('.metrics.json'), dataset=str(meta.path))
+        metrics.write_prometheus(output.with_suffix('.prom'), dataset=str(meta.path))
+
+
+def run_catalog(
+    metas: list[Meta],
+    output_dir: Path,
+    processes: int = 4,
+    timeout: float | None = None,
+    agent_options: dict[str, Any] | None = None,
+    annotate_options: dict[str, Any] | None = None,
+) -> list[CatalogResult]:
+    """
+    Annotate every dataset in the catalog, running up to `processes` datasets at a time, each in its own process.
+
+    Each AnnotationSchema is written to `output_dir/<file name>.json` as soon as its dataset finishes. Datasets still
+    running after `timeout` seconds are killed. `agent_options` are the keyword arguments for constructing each
+    process's Agent (plus an optional `cache_path` for a shared ResponseCache), and `annotate_options` are passed to
+    `annotate_file`. Workers can't prompt the user, so datasets that need user input fail.
+
+    Returns one result per dataset, in the same order as metas.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    agent_options = agent_options or {'model': 'gpt-4-turbo-preview', 'timeout': 10.0}
+    annotate_options = annotate_options or {}
+
+    results: list[CatalogResult | None] = [None] * len(metas)
+    pending = list(enumerate(metas))
+    running: dict[int, tuple[mp.Process, Connection, float]] = {}
+
+    def finish(i: int, status: str, error: str | None):
+        proc, conn, start = running.pop(i)
+        conn.close()
+        output = output_path(metas[i], output_dir) if status == 'done' else None
+        results[i] = CatalogResult(metas[i], status, output, perf_counter() - start, error)
+        print(f'[{status}] {metas[i].path} in {results[i].seconds:.1f}s' + (f'\n{error}' if error else ''))
+
+    while pending or running:
+        # keep the pool full
+        while pending and len(running) < processes:
+            i, meta = pending.pop(0)
+            recv_conn, send_conn = mp.Pipe(duplex=False)
+            proc = mp.Process(
+                target=_annotate_worker,
+                args=(meta, output_path(meta, output_dir), {**agent_options}, annotate_options, send_conn),
+                daemon=True,
+            )
+            proc.start()
+            send_conn.close()
+            running[i] = (proc, recv_conn, perf_counter())
+
+        # wait for any worker to report back, or for the next deadline
+        wait([conn for _, conn, _ in running.values()], timeout=0.5)
+
+        for i, (proc, conn, start) in [*running.items()]:
+            if conn.poll():
+                try:
+                    error = conn.recv()
+                except EOFError:
+                    error = f'worker exited with code {proc.exitcode} without reporting a result'
+                proc.join()
+                finish(i, 'failed' if error else 'done', error)
+            elif not proc.is_alive():
+                finish(i, 'failed', f'worker exited with code {proc.exitcode} without reporting a result')
+            elif timeout is not None and perf_counter() - start > timeout:
+                proc.kill()
+                proc.join()
+                finish(i, 'timeout', f'timed out after {timeout}s')
+
+    return results
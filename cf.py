@@ -0,0 +1,66 @@
+"""
+Annotation of variables from their CF (Climate and Forecast) convention attributes, without the LLM.
+
+CF-compliant files declare what each coordinate is via `standard_name`, `units` and `axis`, so lat/lon/time (and
+vertical) coordinates can be identified directly, and data variables carry their own units and long names.
+See https://cfconventions.org/Data/cf-conventions/cf-conventions-1.11/cf-conventions.html#coordinate-types
+"""
+from __future__ import annotations
+
+import re
+import xarray as xr
+
+from MetadataSchema import ColumnType, DateType, GeoType
+
+
+LATITUDE_UNITS = {'degrees_north', 'degree_north', 'degree_N', 'degrees_N', 'degreeN', 'degreesN'}
+LONGITUDE_UNITS = {'degrees_east', 'degree_east', 'degree_E', 'degrees_E', 'degreeE', 'degreesE'}
+TIME_UNITS = re.compile(r'^\s*(?:seconds?|secs?|s|minutes?|mins?|hours?|hrs?|h|days?|d|weeks?|months?|years?)\s+since\s+', re.IGNORECASE)
+VERTICAL_STANDARD_NAMES = {
+    'air_pressure', 'altitude', 'depth', 'height', 'height_above_mean_sea_level', 'model_level_number',
+    'atmosphere_sigma_coordinate', 'atmosphere_hybrid_sigma_pressure_coordinate', 'ocean_sigma_coordinate',
+}
+
+
+def cf_attrs(var: xr.Variable) -> dict:
+    """
+    The variable's attributes, plus the CF attributes xarray moves into the encoding when it decodes times
+    (i.e. the `units` and `calendar` of a time coordinate)
+    """
+    return {**{k: var.encoding[k] for k in ('units', 'calendar') if k in var.encoding}, **var.attrs}
+
+
+def cf_coordinate_type(var: xr.Variable) -> tuple[ColumnType, GeoType | DateType | None] | None:
+    """
+    Identify a coordinate from its CF attributes, or None if they don't say what it is.
+    Vertical coordinates (pressure levels, depth, etc.) are features
+    """
+    attrs = cf_attrs(var)
+    standard_name = attrs.get('standard_name')
+    units = attrs.get('units')
+    axis = str(attrs.get('axis', '')).upper()
+
+    if standard_name == 'latitude' or units in LATITUDE_UNITS:
+        return ColumnType.GEO, GeoType.LATITUDE
+    if standard_name == 'longitude' or units in LONGITUDE_UNITS:
+        return ColumnType.GEO, GeoType.LONGITUDE
+    if standard_name == 'time' or axis == 'T' or 'calendar' in attrs or (isinstance(units, str) and TIME_UNITS.match(units)):
+        return ColumnType.DATE, DateType.DATE
+    if standard_name in VERTICAL_STANDARD_NAMES or axis == 'Z' or 'positive' in attrs:
+        return ColumnType.FEATURE, None
+    return None
+
+
+def cf_description(var: xr.Variable) -> str | None:
+    """description from the variable's long_name, or its standard_name if it has no long name"""
+    attrs = var.attrs
+    if isinstance(attrs.get('long_name'), str) and attrs['long_name'].strip():
+        return attrs['long_name'].strip()
+    if isinstance(attrs.get('standard_name'), str):
+        return attrs['standard_name'].replace('_', ' ')
+    return None
+
+
+def cf_units(var: xr.Variable) -> str | None:
+    units = cf_attrs(var).get('units')
+    return units if isinstance(units, str) and units.strip() else None
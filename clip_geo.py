@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from MetadataSchema import AnnotationSchema, ClipGeo, GeoType, LatLong
+
+
+@dataclass
+class ShapeIndex:
+    """
+    Polygons to clip points against, with a uniform grid over their combined bounding box as a spatial index.
+    Points are bucketed by grid cell once, so each shape is only tested against the points in the cells its bounding
+    box overlaps, and then only those inside the bounding box itself.
+    """
+    polygons: list[np.ndarray]  # (n_vertices, 2) arrays of lon, lat
+    bboxes: np.ndarray  # (n_shapes, 4) min lon, min lat, max lon, max lat
+    extent: tuple[float, float, float, float]  # bounding box of every shape
+    cells: int  # the grid is cells x cells
+
+    @classmethod
+    def from_shapes(cls, map_shapes: list[list[LatLong]], cells: int | None = None) -> ShapeIndex:
+        polygons = [np.array([(p.lng, p.lat) for p in shape], dtype=float) for shape in map_shapes if len(shape) >= 3]
+        if not polygons:
+            return cls([], np.empty((0, 4)), (0.0, 0.0, 0.0, 0.0), 1)
+        bboxes = np.array([[*poly.min(axis=0), *poly.max(axis=0)] for poly in polygons])
+        extent = (bboxes[:, 0].min(), bboxes[:, 1].min(), bboxes[:, 2].max(), bboxes[:, 3].max())
+        if cells is None:
+            # a few cells per shape along each axis keeps both the cell lists and the points per cell small
+            cells = int(4 * math.sqrt(len(polygons)))
+        # at most 256 x 256 cells, so cell ids fit in uint16, which numpy sorts with a (much faster) radix sort
+        cells = max(1, min(256, cells))
+        return cls(polygons, bboxes, extent, cells)
+
+    def _cell_coords(self, lon: np.ndarray, lat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        x0, y0, x1, y1 = self.extent
+        width, height = max(x1 - x0, 1e-12), max(y1 - y0, 1e-12)
+        ix = np.clip(((lon - x0) / width * self.cells).astype(np.int64), 0, self.cells - 1)
+        iy = np.clip(((lat - y0) / height * self.cells).astype(np.int64), 0, self.cells - 1)
+        return ix, iy
+
+    def contains(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Boolean mask of the points inside any of the shapes. Points with missing coordinates are outside"""
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        inside = np.zeros(len(lat), dtype=bool)
+        if not self.polygons:
+            return inside
+
+        # drop points outside every shape's bounding box, then bucket the rest by grid cell
+        x0, y0, x1, y1 = self.extent
+        with np.errstate(invalid='ignore'):
+            candidates = np.flatnonzero((lon >= x0) & (lon <= x1) & (lat >= y0) & (lat <= y1))
+        ix, iy = self._cell_coords(lon[candidates], lat[candidates])
+        cell = (iy * self.cells + ix).astype(np.uint16)
+        order = np.argsort(cell, kind='stable')
+        by_cell = candidates[order]
+        starts = np.searchsorted(cell[order], np.arange(self.cells * self.cells + 1))
+
+        shape_x0, shape_y0 = self._cell_coords(self.bboxes[:, 0], self.bboxes[:, 1])
+        shape_x1, shape_y1 = self._cell_coords(self.bboxes[:, 2], self.bboxes[:, 3])
+        for s, poly in enumerate(self.polygons):
+            # cells in a row of the shape's bounding box are contiguous in by_cell, so each row is one slice
+            rows = [
+                by_cell[starts[row * self.cells + shape_x0[s]]:starts[row * self.cells + shape_x1[s] + 1]]
+                for row in range(shape_y0[s], shape_y1[s] + 1)
+            ]
+            idx = np.concatenate(rows)
+            idx = idx[~inside[idx]]
+            min_lon, min_lat, max_lon, max_lat = self.bboxes[s]
+            px, py = lon[idx], lat[idx]
+            in_bbox = (px >= min_lon) & (px <= max_lon) & (py >= min_lat) & (py <= max_lat)
+            idx, px, py = idx[in_bbox], px[in_bbox], py[in_bbox]
+            inside[idx[points_in_polygon(px, py, poly)]] = True
+        return inside
+
+
+def points_in_polygon(x: np.ndarray, y: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """Even-odd rule test of many points against one polygon, vectorized over the points (one pass per edge)"""
+    inside = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return inside
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for ax, ay, bx, by in zip(x1, y1, x2, y2):
+            # edges crossing the horizontal line through the point, to the right of it
+            crosses = (ay > y) != (by > y)
+            if not crosses.any():
+                continue
+            inside ^= crosses & (x < (bx - ax) * (y - ay) / (by - ay) + ax)
+    return inside
+
+
+def latlon_columns(clip: ClipGeo, annotations: AnnotationSchema | None = None) -> tuple[str, str]:
+    """
+    The (lat, lon) columns to clip: from the transformation's geo_columns (`lat_column`/`lon_column`), falling back to
+    the primary (or else first) lat/lon pair in the annotations
+    """
+    lat, lon = clip.geo_columns.get('lat_column'), clip.geo_columns.get('lon_column')
+    if lat and lon:
+        return lat, lon
+
+    geos = {geo.name: geo for geo in (annotations.geo or [])} if annotations is not None else {}
+    pairs = sorted((geo for geo in geos.values() if geo.is_geo_pair in geos), key=lambda geo: not geo.primary_geo)
+    if not pairs:
+        raise ValueError('ClipGeo needs lat_column and lon_column in geo_columns, or annotations with a lat/lon pair')
+    first, second = pairs[0].name, pairs[0].is_geo_pair
+    return (second, first) if geos[first].geo_type == GeoType.LONGITUDE else (first, second)
+
+
+def clip_geo(df: pd.DataFrame, clip: ClipGeo, annotations: AnnotationSchema | None = None, index: ShapeIndex | None = None) -> pd.DataFrame:
+    """The rows of df whose lat/lon (see `latlon_columns`) fall inside any of the transformation's map_shapes"""
+    lat, lon = latlon_columns(clip, annotations)
+    index = index if index is not None else ShapeIndex.from_shapes(clip.map_shapes)
+    mask = index.contains(pd.to_numeric(df[lat], errors='coerce').to_numpy(), pd.to_numeric(df[lon], errors='coerce').to_numpy())
+    return df[mask]
+
+
+def clip_geo_csv(src: str | Path, dst: str | Path, clip: ClipGeo, annotations: AnnotationSchema | None = None, chunksize: int = 1_000_000) -> int:
+    """
+    Clip a CSV (see `clip_geo`) that may be bigger than memory, streaming it `chunksize` rows at a time into dst.
+    Returns the number of rows kept
+    """
+    index = ShapeIndex.from_shapes(clip.map_shapes)
+    kept = 0
+    header = True
+    for chunk in pd.read_csv(src, chunksize=chunksize):
+        clipped = clip_geo(chunk, clip, annotations, index)
+        clipped.to_csv(dst, mode='w' if header else 'a', header=header, index=False)
+        header = False
+        kept += len(clipped)
+    if header:
+        # empty input: still write the header
+        pd.read_csv(src, nrows=0).to_csv(dst, index=False)
+    return kept
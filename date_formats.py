@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import re
+import warnings
+from datetime import datetime
+from itertools import product
+
+import pandas as pd
+
+from strftime_codes import PARSEABLE_CODES
+
+
+# fraction of a column's values a format must parse to be accepted
+MIN_PARSE_RATIO = 0.95
+
+# building blocks for the candidate formats of DateType.DATE columns
+DATE_PARTS = [
+    '%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%Y%m%d',
+    '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%m-%d-%Y', '%d.%m.%Y',
+    '%d/%m/%y', '%m/%d/%y', '%y-%m-%d',
+    '%b %d, %Y', '%B %d, %Y', '%d %b %Y', '%d %B %Y', '%d-%b-%Y', '%d-%b-%y', '%b %d %Y', '%a %b %d %Y',
+    '%Y-%m', '%Y/%m', '%m/%Y', '%b %Y', '%B %Y', '%b-%y',
+    '%Y-%j',
+]
+TIME_PARTS = [
+    '', ' %H:%M', ' %H:%M:%S', ' %H:%M:%S.%f', ' %H:%M:%S%z', ' %I:%M %p', ' %I:%M:%S %p',
+    'T%H:%M', 'T%H:%M:%S', 'T%H:%M:%S.%f', 'T%H:%M:%SZ', 'T%H:%M:%S.%fZ', 'T%H:%M:%S%z', 'T%H:%M:%S.%f%z',
+]
+
+CANDIDATE_FORMATS: dict[str, list[str]] = {
+    'YEAR': ['%Y', '%y'],
+    'MONTH': ['%m', '%b', '%B', '%Y-%m', '%Y/%m', '%m/%Y', '%Y%m', '%b %Y', '%B %Y'],
+    'DAY': ['%d', '%j', '%a', '%A'],
+    'DATE': [date + time for date, time in product(DATE_PARTS, TIME_PARTS)] + ['%c', '%x', '%Y', '%H:%M', '%H:%M:%S'],
+}
+
+
+def _uses_parseable_codes(fmt: str) -> bool:
+    return all(code in PARSEABLE_CODES for code in re.findall('%.', fmt))
+
+
+assert all(_uses_parseable_codes(fmt) for fmts in CANDIDATE_FORMATS.values() for fmt in fmts)
+
+
+def as_date_strings(series: pd.Series) -> pd.Series:
+    """distinct non-null values of the column as strings. Integral floats (e.g. years read with NaNs) lose the .0"""
+    values = series.dropna()
+    if pd.api.types.is_float_dtype(values) and (values == values.round()).all():
+        values = values.astype('int64')
+    return pd.Series(values.astype(str).str.strip().unique())
+
+
+def format_parse_ratio(values: pd.Series, fmt: str) -> float:
+    """fraction of the (string) values that parse exactly with the given strftime format"""
+    if len(values) == 0:
+        return 0.0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        parsed = pd.to_datetime(values, format=fmt, errors='coerce', utc='%z' in fmt)
+    return float(parsed.notna().mean())
+
+
+def unparsed_values(series: pd.Series, fmt: str, n: int = 5) -> list[str]:
+    """up to n distinct values of the column that the format fails to parse"""
+    values = as_date_strings(series)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        parsed = pd.to_datetime(values, format=fmt, errors='coerce', utc='%z' in fmt)
+    return values[parsed.isna()].head(n).tolist()
+
+
+def rank_strftime_formats(series: pd.Series, date_type: str, sample_size: int = 1000) -> list[tuple[str, float]]:
+    """
+    Test each candidate format for the DateType key against a sample of the column's distinct values, returning
+    (format, fraction of values parsed) for every candidate that parses any values, best first.
+    Ties keep the order of CANDIDATE_FORMATS.
+    """
+    values = as_date_strings(series)
+    if len(values) > sample_size:
+        values = values.sample(sample_size, random_state=0)
+
+    # cheaply discard candidates that don't parse any of the first few values before testing the whole sample
+    probe = values.head(5).tolist()
+
+    def parses_any(fmt: str) -> bool:
+        for value in probe:
+            try:
+                datetime.strptime(value, fmt)
+                return True
+            except ValueError:
+                pass
+        return False
+
+    candidates = [fmt for fmt in CANDIDATE_FORMATS.get(date_type, []) if parses_any(fmt)]
+    ranked = [(fmt, format_parse_ratio(values, fmt)) for fmt in candidates]
+    ranked = [(fmt, ratio) for fmt, ratio in ranked if ratio > 0]
+    return sorted(ranked, key=lambda x: -x[1])
+
+
+def distinct_interpretations(series: pd.Series, formats: list[str]) -> list[str]:
+    """
+    Drop formats that parse the column to exactly the same datetimes as an earlier format in the list, e.g. '%d' and
+    '%j' on day numbers, or a literal 'Z' vs '%z'. Formats that remain genuinely disagree, e.g. '%d/%m/%Y' vs '%m/%d/%Y'.
+    Every distinct value is compared, since formats can agree on a whole run of values (e.g. a day of minute-level
+    data on 01/01) and only disagree further on.
+    """
+    values = as_date_strings(series)
+    distinct: list[tuple[str, pd.Series]] = []
+    for fmt in formats:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            parsed = pd.to_datetime(values, format=fmt, errors='coerce', utc=True)
+        if not any(parsed.equals(other) for _, other in distinct):
+            distinct.append((fmt, parsed))
+    return [fmt for fmt, _ in distinct]
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+from MetadataSchema import AnnotationSchema
+from profiler import ColumnProfile
+
+
+def _range_signature(lo: float, hi: float) -> str:
+    """coarse description of a numeric range: whether it goes negative, and the order of magnitude of its extent"""
+    extent = max(abs(lo), abs(hi))
+    if not math.isfinite(extent):
+        return f'range:{lo}:{hi}'
+    magnitude = math.floor(math.log10(extent)) if extent > 0 else 'zero'
+    return f'range:{"signed" if lo < 0 else "unsigned"}:1e{magnitude}'
+
+
+def column_signature(profile: ColumnProfile) -> str:
+    """
+    Coarse description of a column's name, dtype and values. It is meant to stay the same across e.g. monthly drops
+    of the same dataset, but change when a column is renamed, retyped, or holds a different kind of values
+    """
+    if profile.count == 0:
+        values = 'empty'
+    elif isinstance(profile.min, (int, float)) and isinstance(profile.max, (int, float)):
+        values = _range_signature(profile.min, profile.max)
+    elif profile.n_unique == profile.count:
+        values = 'unique'
+    elif profile.n_unique <= 50:
+        values = 'categorical'
+    else:
+        values = 'text'
+    nulls = 'none' if profile.null_ratio == 0 else 'sparse' if profile.null_ratio > 0.5 else 'some'
+    return f'{profile.name}|{profile.dtype}|{values}|nulls:{nulls}'
+
+
+def schema_fingerprint(signatures: dict[str, str]) -> str:
+    """hash of the column signatures, in column order"""
+    return hashlib.sha256('\n'.join(signatures.values()).encode('utf-8')).hexdigest()
+
+
+def signatures_path(annotations_path: Path) -> Path:
+    """where the column signatures of the annotations saved at annotations_path go, e.g. data.csv.signatures.json"""
+    return annotations_path.with_suffix('.signatures.json')
+
+
+def save_signatures(annotations_path: Path, signatures: dict[str, str]):
+    """Save column signatures next to the annotations of a dataset, for diffing a later version of it against"""
+    signatures_path(annotations_path).write_text(json.dumps(signatures, indent=2))
+
+
+def load_signatures(annotations_path: Path) -> dict[str, str] | None:
+    """the column signatures saved next to the annotations at annotations_path, if any"""
+    path = signatures_path(annotations_path)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+@dataclass
+class StoredAnnotation:
+    fingerprint: str
+    signatures: dict[str, str]
+    annotations: AnnotationSchema
+    source: str
+
+
+class AnnotationStore:
+    """
+    Directory of previously annotated datasets, indexed by schema fingerprint, so that datasets with the same schema
+    (e.g. recurring drops of the same data) can reuse an earlier AnnotationSchema instead of going through the LLM again.
+    Only holds a path, so it can be passed to worker processes.
+    """
+
+    def __init__(self, path: str | Path = '.annotation_store'):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, fingerprint: str) -> Path:
+        return self.path / f'{fingerprint}.json'
+
+    def get(self, fingerprint: str) -> StoredAnnotation | None:
+        path = self._entry_path(fingerprint)
+        if not path.exists():
+            return None
+        return self._load(path)
+
+    def put(self, signatures: dict[str, str], annotations: AnnotationSchema, source: str):
+        fingerprint = schema_fingerprint(signatures)
+        entry = {
+            'fingerprint': fingerprint,
+            'signatures': signatures,
+            'annotations': annotations.model_dump(mode='json'),
+            'source': source,
+        }
+        # write then rename, so readers never see a partial file
+        tmp = self._entry_path(fingerprint).with_suffix('.tmp')
+        tmp.write_text(json.dumps(entry, indent=2))
+        tmp.replace(self._entry_path(fingerprint))
+
+    def find_similar(self, signatures: dict[str, str], min_overlap: float = 0.5) -> StoredAnnotation | None:
+        """The stored dataset sharing the largest fraction of column signatures, if it shares at least min_overlap"""
+        wanted = set(signatures.values())
+        best, best_overlap = None, min_overlap
+        for path in self.path.glob('*.json'):
+            entry = self._load(path)
+            stored = set(entry.signatures.values())
+            overlap = len(wanted & stored) / len(wanted | stored) if wanted | stored else 0
+            if overlap >= best_overlap:
+                best, best_overlap = entry, overlap
+        return best
+
+    @contextmanager
+    def claim(self, fingerprint: str, timeout: float = 3600) -> Iterator[None]:
+        """
+        Hold an exclusive claim on annotating a fingerprint, waiting while another process holds it.
+        This way concurrent catalog workers annotate a shared schema once, and the rest reuse the result
+        """
+        lock = self._entry_path(fingerprint).with_suffix('.lock')
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                break
+            except FileExistsError:
+                if not _lock_owner_alive(lock):
+                    # e.g. the owner was killed by a catalog timeout
+                    lock.unlink(missing_ok=True)
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError(f'Timed out waiting for another process to annotate schema {fingerprint}')
+                time.sleep(0.5)
+        try:
+            yield
+        finally:
+            lock.unlink(missing_ok=True)
+
+    @staticmethod
+    def _load(path: Path) -> StoredAnnotation:
+        entry = json.loads(path.read_text())
+        return StoredAnnotation(
+            fingerprint=entry['fingerprint'],
+            signatures=entry['signatures'],
+            annotations=AnnotationSchema(**entry['annotations']),
+            source=entry['source'],
+        )
+
+
+# how long a lock file may go without its owner's pid before it's considered abandoned
+LOCK_WRITE_GRACE = 5.0
+
+
+def _lock_owner_alive(lock: Path) -> bool:
+    try:
+        pid = int(lock.read_text())
+    except FileNotFoundError:
+        return True  # already released, so the next attempt will get it
+    except ValueError:
+        # empty or partly written: either just created, or its owner died before writing its pid
+        try:
+            return time.time() - lock.stat().st_mtime < LOCK_WRITE_GRACE
+        except FileNotFoundError:
+            return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
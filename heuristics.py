@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import re
+import warnings
+from dataclasses import dataclass
+
+import pandas as pd
+
+from iso_codes import ISO2_CODES, ISO3_CODES, US_STATE_CODES
+from profiler import ColumnProfile
+
+
+@dataclass
+class Guess:
+    """A rule-based classification of a column"""
+    column_type: str  # ColumnType key, e.g. 'GEO'
+    subtype: str  # DateType/GeoType/FeatureType key, e.g. 'LATITUDE'
+    confidence: float
+    reason: str
+
+
+LAT_NAMES = {'lat', 'latitude', 'y'}
+LON_NAMES = {'lon', 'lng', 'long', 'longitude', 'x'}
+YEAR_NAMES = {'year', 'yr', 'yyyy'}
+MONTH_NAMES = {'month', 'mon', 'mm'}
+DAY_NAMES = {'day', 'dd'}
+DATE_NAMES = {'date', 'time', 'datetime', 'timestamp'}
+COUNTRY_NAMES = {'iso', 'iso2', 'iso3', 'iso_code', 'country', 'code', 'cc'}
+
+# only strings with some date-like punctuation/words are tested as datetimes, so plain numbers/words aren't matched
+DATETIME_LIKE = re.compile(
+    r'\d{1,4}[-/.:]\d{1,2}|\d{4}\d{2}\d{2}T|\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b', re.IGNORECASE)
+
+
+def name_tokens(name: str) -> set[str]:
+    """split a column name into lower case words, e.g. 'StationLat_deg' -> {'station', 'lat', 'deg'}"""
+    name = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(name))
+    return {t for t in re.split(r'[^a-zA-Z0-9]+', name.lower()) if t}
+
+
+def _is_integral(series: pd.Series) -> bool:
+    if pd.api.types.is_integer_dtype(series):
+        return True
+    if pd.api.types.is_float_dtype(series):
+        non_null = series.dropna()
+        return len(non_null) > 0 and bool((non_null == non_null.round()).all())
+    return False
+
+
+def guess_column(series: pd.Series, profile: ColumnProfile) -> Guess | None:
+    """Apply the rules to a single column, returning the most confident match, if any"""
+    if profile.count == 0:
+        return None
+
+    tokens = name_tokens(series.name)
+    guesses: list[Guess] = []
+    is_numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+    if pd.api.types.is_bool_dtype(series):
+        guesses.append(Guess('FEATURE', 'BOOLEAN', 0.95, 'boolean dtype'))
+
+    if pd.api.types.is_datetime64_any_dtype(series):
+        guesses.append(Guess('DATE', 'DATE', 0.99, 'datetime dtype'))
+
+    if is_numeric:
+        lo, hi = profile.min, profile.max
+        if -90 <= lo and hi <= 90 and tokens & LAT_NAMES:
+            confidence = 0.95 if tokens & (LAT_NAMES - {'y'}) else 0.8
+            guesses.append(Guess('GEO', 'LATITUDE', confidence, f'latitude name with values in [{lo:g}, {hi:g}]'))
+        if -180 <= lo and hi <= 360 and tokens & LON_NAMES:
+            confidence = 0.95 if tokens & (LON_NAMES - {'x', 'long'}) else 0.8
+            guesses.append(Guess('GEO', 'LONGITUDE', confidence, f'longitude name with values in [{lo:g}, {hi:g}]'))
+
+        if _is_integral(series):
+            if 1800 <= lo and hi <= 2100:
+                confidence = 0.95 if tokens & YEAR_NAMES else 0.7
+                guesses.append(Guess('DATE', 'YEAR', confidence, f'4 digit integers in [{lo:g}, {hi:g}]'))
+            if 1 <= lo and hi <= 12 and tokens & MONTH_NAMES:
+                guesses.append(Guess('DATE', 'MONTH', 0.95, f'month name with integers in [{lo:g}, {hi:g}]'))
+            if 1 <= lo and hi <= 31 and tokens & DAY_NAMES:
+                guesses.append(Guess('DATE', 'DAY', 0.95, f'day name with integers in [{lo:g}, {hi:g}]'))
+
+    if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+        # tests are run over the distinct values rather than every row
+        values = pd.Series(series.dropna().unique()).astype(str).str.strip()
+        lengths = values.str.len()
+        is_upper = values.str.isupper() & values.str.isalpha()
+
+        if (lengths == 2).all() and is_upper.all():
+            matched = values.isin(ISO2_CODES).mean()
+            if matched >= 0.95:
+                confidence = 0.95 if tokens & COUNTRY_NAMES else 0.85
+                if values.isin(US_STATE_CODES).all() and not tokens & COUNTRY_NAMES:
+                    confidence = 0.5  # could just as well be US state abbreviations
+                guesses.append(Guess('GEO', 'ISO2', confidence, f'{matched:.0%} of values are ISO2 codes'))
+
+        if (lengths == 3).all() and is_upper.all():
+            matched = values.isin(ISO3_CODES).mean()
+            if matched >= 0.95:
+                confidence = 0.95 if tokens & COUNTRY_NAMES or len(values) >= 5 else 0.8
+                guesses.append(Guess('GEO', 'ISO3', confidence, f'{matched:.0%} of values are ISO3 codes'))
+
+        sample = values.head(200)
+        date_like = sample.str.contains(DATETIME_LIKE).mean() if len(sample) else 0
+        if date_like >= 0.95:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                parsed = pd.to_datetime(sample, errors='coerce', format='mixed')
+            parsed_ratio = parsed.notna().mean()
+            if parsed_ratio >= 0.95:
+                confidence = 0.95 if tokens & DATE_NAMES else 0.9
+                guesses.append(Guess('DATE', 'DATE', confidence, f'{parsed_ratio:.0%} of values parse as datetimes'))
+
+    if not guesses:
+        return None
+    return max(guesses, key=lambda g: g.confidence)
+
+
+def guess_columns(df: pd.DataFrame, profiles: dict[str, ColumnProfile], threshold: float = 0.9) -> dict[str, Guess]:
+    """Run the rules over every column, returning the guesses with at least the threshold confidence"""
+    guesses = {col: guess_column(df[col], profiles[col]) for col in df.columns}
+    return {col: guess for col, guess in guesses.items() if guess is not None and guess.confidence >= threshold}
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import json
+import math
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+
+
+# the pipeline stage the current code (and any LLM calls it makes) belongs to.
+# utils.map_concurrent copies the context into its worker threads, so calls made there are attributed correctly
+_current_stage: ContextVar[str] = ContextVar('stage', default='other')
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, math.inf)
+
+
+def current_stage() -> str:
+    return _current_stage.get()
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...] = LATENCY_BUCKETS
+    counts: list[int] = field(default_factory=lambda: [0] * len(LATENCY_BUCKETS))
+    sum: float = 0.0
+    count: int = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+@dataclass
+class StageMetrics:
+    seconds: Histogram = field(default_factory=Histogram)
+    llm_calls: int = 0
+    llm_latency: Histogram = field(default_factory=Histogram)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # how much of prompt_tokens/completion_tokens was estimated from the text, rather than reported by the API
+    estimated_prompt_tokens: int = 0
+    estimated_completion_tokens: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+
+class Metrics:
+    """
+    Per-stage timings and LLM usage (call counts, latencies, tokens and response cache hits) of an annotation run.
+
+    Pipelines mark their stages with `stage()` (or a `StageTimer`), and the Agent records every LLM call against the
+    stage it was made in. Export with `write_json()` or `write_prometheus()`.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.stages: dict[str, StageMetrics] = {}
+
+    def _stage(self, name: str) -> StageMetrics:
+        if name not in self.stages:
+            self.stages[name] = StageMetrics()
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        token = _current_stage.set(name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, perf_counter() - start)
+            _current_stage.reset(token)
+
+    def record_stage(self, name: str, seconds: float):
+        with self._lock:
+            self._stage(name).seconds.observe(seconds)
+
+    def record_call(self, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0, estimated: bool = False):
+        with self._lock:
+            stage = self._stage(current_stage())
+            stage.llm_calls += 1
+            stage.llm_latency.observe(seconds)
+            stage.prompt_tokens += prompt_tokens
+            stage.completion_tokens += completion_tokens
+            if estimated:
+                stage.estimated_prompt_tokens += prompt_tokens
+                stage.estimated_completion_tokens += completion_tokens
+
+    def record_cache(self, hit: bool):
+        with self._lock:
+            stage = self._stage(current_stage())
+            if hit:
+                stage.cache_hits += 1
+            else:
+                stage.cache_misses += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            stages = {name: asdict(stage) for name, stage in self.stages.items()}
+        totals = {
+            key: sum(stage[key] for stage in stages.values())
+            for key in ('llm_calls', 'prompt_tokens', 'completion_tokens', 'estimated_prompt_tokens', 'estimated_completion_tokens', 'cache_hits', 'cache_misses')
+        }
+        for stage in stages.values():
+            for hist in (stage['seconds'], stage['llm_latency']):
+                hist['buckets'] = [str(b) for b in hist['buckets']]  # inf isn't valid JSON
+        return {'totals': totals, 'stages': stages}
+
+    def write_json(self, path: Path, **labels: str):
+        path.write_text(json.dumps({**labels, **self.report()}, indent=2))
+
+    def write_prometheus(self, path: Path, **labels: str):
+        """Write the metrics in the Prometheus text format, e.g. for node_exporter's textfile collector"""
+        with self._lock:
+            stages = {name: asdict(stage) for name, stage in self.stages.items()}
+
+        lines = []
+
+        def metric(name: str, kind: str, help: str):
+            lines.append(f'# HELP annotator_{name} {help}')
+            lines.append(f'# TYPE annotator_{name} {kind}')
+
+        def sample(name: str, value: float, **extra: str):
+            label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in {**labels, **extra}.items())
+            lines.append(f'annotator_{name}{{{label_str}}} {value}')
+
+        def histogram(name: str, key: str):
+            for stage_name, stage in stages.items():
+                hist = stage[key]
+                cumulative = 0
+                for bound, count in zip(hist['buckets'], hist['counts']):
+                    cumulative += count
+                    sample(f'{name}_bucket', cumulative, stage=stage_name, le='+Inf' if math.isinf(bound) else str(bound))
+                sample(f'{name}_sum', hist['sum'], stage=stage_name)
+                sample(f'{name}_count', hist['count'], stage=stage_name)
+
+        metric('stage_seconds', 'histogram', 'Wall time spent in each annotation stage.')
+        histogram('stage_seconds', 'seconds')
+        metric('llm_latency_seconds', 'histogram', 'Latency of LLM calls, by the stage that made them.')
+        histogram('llm_latency_seconds', 'llm_latency')
+        for key, help in (
+            ('llm_calls', 'LLM calls made (excluding response cache hits).'),
+            ('prompt_tokens', 'Prompt tokens sent to the LLM.'),
+            ('completion_tokens', 'Completion tokens received from the LLM.'),
+            ('estimated_prompt_tokens', 'Part of prompt_tokens estimated from the text, where the API reported no usage.'),
+            ('estimated_completion_tokens', 'Part of completion_tokens estimated from the text, where the API reported no usage.'),
+            ('cache_hits', 'LLM response cache hits.'),
+            ('cache_misses', 'LLM response cache misses.'),
+        ):
+            metric(f'{key}_total', 'counter', help)
+            for stage_name, stage in stages.items():
+                sample(f'{key}_total', stage[key], stage=stage_name)
+
+        # write then rename, so the collector never reads a partial file
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text('\n'.join(lines) + '\n')
+        tmp.replace(path)
+
+
+class StageTimer:
+    """
+    Marks the stages of a linear pipeline: each call ends the previous stage and starts the named one, and `done()`
+    ends the last. Without metrics, stages are still tracked (for attributing LLM calls) but not timed
+    """
+
+    def __init__(self, metrics: Metrics | None):
+        self.metrics = metrics
+        self._name: str | None = None
+        self._start = 0.0
+        self._token = None
+
+    def __call__(self, name: str):
+        self._record()
+        if self._token is None:
+            self._token = _current_stage.set(name)
+        else:
+            _current_stage.set(name)
+        self._name, self._start = name, perf_counter()
+
+    def done(self):
+        self._record()
+        if self._token is not None:
+            _current_stage.reset(self._token)
+            self._token = None
+
+    def _record(self):
+        if self._name is not None and self.metrics is not None:
+            self.metrics.record_stage(self._name, perf_counter() - self._start)
+        self._name = None
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from io import StringIO
+from itertools import islice
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+
+SamplingMethod = Literal['head', 'reservoir', 'byte_range']
+
+
+@dataclass
+class LazyCsv:
+    """
+    A bounded row sample of a CSV file, plus a handle for reading more of the file only if a later stage needs it.
+
+    Use `sample_csv()` to construct.
+    """
+    path: Path
+    sample: pd.DataFrame
+    method: SamplingMethod
+    _columns: dict[str, pd.Series] = field(default_factory=dict, repr=False)
+
+    def load(self, nrows: int | None = None) -> pd.DataFrame:
+        """Read the first nrows rows of the file, or the whole file if nrows is None"""
+        return pd.read_csv(self.path, nrows=nrows)
+
+    def columns(self, cols: list[str]) -> pd.DataFrame:
+        """
+        Read every row of the given columns. Columns not read before are read together in one pass over the file, and
+        cached, so each column is only read once
+        """
+        missing = [col for col in cols if col not in self._columns]
+        if missing:
+            self._columns.update(pd.read_csv(self.path, usecols=missing).items())
+        return pd.DataFrame({col: self._columns[col] for col in cols})
+
+    def column(self, col: str) -> pd.Series:
+        """Read every row of a single column (see `columns`)"""
+        return self.columns([col])[col]
+
+
+def sample_csv(path: Path, sample_rows: int = 10_000, method: SamplingMethod = 'head', seed: int = 0) -> LazyCsv:
+    """
+    Read a sample of at most sample_rows rows from a CSV without parsing the whole file into memory.
+
+    Methods:
+    - head: the header plus the first sample_rows rows. Only reads the start of the file.
+    - reservoir: a uniform random sample of rows. Streams over the whole file in chunks, with memory bounded by the sample size.
+    - byte_range: rows from evenly spaced byte offsets across the file. Only reads the sampled ranges, so cost does
+      not grow with file size. Assumes records do not contain embedded newlines.
+    """
+    path = Path(path)
+    if method == 'head':
+        sample = pd.read_csv(path, nrows=sample_rows)
+    elif method == 'reservoir':
+        sample = _reservoir_sample(path, sample_rows, seed)
+    elif method == 'byte_range':
+        sample = _byte_range_sample(path, sample_rows, seed)
+    else:
+        raise ValueError(f'Unknown sampling method: {method}')
+
+    return LazyCsv(path, sample, method)
+
+
+def _reservoir_sample(path: Path, sample_rows: int, seed: int, chunksize: int = 100_000) -> pd.DataFrame:
+    # reservoir sampling by random priority: keep the rows with the sample_rows smallest random keys seen so far
+    rng = np.random.default_rng(seed)
+    reservoir: pd.DataFrame | None = None
+    keys = np.empty(0)
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        chunk_keys = rng.random(len(chunk))
+        if reservoir is None:
+            reservoir, keys = chunk, chunk_keys
+        else:
+            reservoir, keys = pd.concat([reservoir, chunk]), np.concatenate([keys, chunk_keys])
+        if len(reservoir) > sample_rows:
+            keep = np.argpartition(keys, sample_rows)[:sample_rows]
+            reservoir, keys = reservoir.iloc[keep], keys[keep]
+
+    if reservoir is None:
+        return pd.read_csv(path, nrows=0)
+
+    # restore file order
+    return reservoir.sort_index()
+
+
+def _byte_range_sample(path: Path, sample_rows: int, seed: int, n_ranges: int = 32) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    size = path.stat().st_size
+    n_ranges = max(1, min(n_ranges, sample_rows))
+    rows_per_range = -(-sample_rows // n_ranges)
+
+    with open(path, 'rb') as f:
+        header = f.readline()
+        data_start = f.tell()
+        span = max(size - data_start, 1)
+
+        # evenly spaced offsets, jittered within each stride
+        stride = span / n_ranges
+        offsets = data_start + (np.arange(n_ranges) + rng.random(n_ranges)) * stride
+        offsets[0] = data_start
+
+        lines: dict[int, bytes] = {}  # line start position -> line, so overlapping ranges don't duplicate rows
+        for offset in offsets.astype(int):
+            f.seek(offset)
+            if offset != data_start:
+                f.readline()  # skip the partial line we landed in
+            for _ in range(rows_per_range):
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if pos in lines:
+                    break  # reached rows already read by a previous range
+                lines[pos] = line if line.endswith(b'\n') else line + b'\n'
+
+    text = header + b''.join(lines[pos] for pos in sorted(lines)[:sample_rows])
+    return pd.read_csv(StringIO(text.decode('utf-8-sig', errors='replace')))
+
+
+def list_sheets(path: Path) -> list[str]:
+    """Names of every sheet in an Excel workbook, in workbook order"""
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def dedup_names(names: list, last: set[int] = frozenset()) -> list:
+    """
+    Rename repeated column names the way pandas does: each repeat gets the first ".<n>" suffix not already among the
+    names. The names at the `last` positions are renamed after the others
+    """
+    names = [*names]
+    counts = {}
+    for i in [i for i in range(len(names)) if i not in last] + sorted(last):
+        name = original = names[i]
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[original] = count + 1
+            name = f'{original}.{count}'
+            count = count + 1 if name in names else counts.get(name, 0)
+        names[i] = name
+        counts[name] = count + 1
+    return names
+
+
+def sample_excel(path: Path, sheet: str | int = 0, sample_rows: int | None = 10_000) -> pd.DataFrame:
+    """
+    Read the header and the first sample_rows rows (or every row, if sample_rows is None) of one sheet of an Excel workbook.
+
+    Uses openpyxl's read-only mode, which streams rows from the file instead of building the workbook's full object
+    model, so only the sampled rows are ever held in memory. Cell values are read as stored (formulas are not evaluated).
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if isinstance(sheet, str) else workbook.worksheets[sheet]
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        data = [*islice(rows, sample_rows)]
+    finally:
+        workbook.close()
+
+    if header is None:
+        return pd.DataFrame()
+
+    # name columns the way pd.read_excel does: headers keep their values (e.g. the int 2020), and blank headers become
+    # "Unnamed: <i>", deduplicated after the rest
+    columns = [f'Unnamed: {i}' if name is None else name for i, name in enumerate(header)]
+    columns = dedup_names(columns, last={i for i, name in enumerate(header) if name is None})
+
+    width = len(columns)
+    # blank rows are kept as all-missing rows, as read_excel does, except trailing ones
+    while data and _is_blank(data[-1]):
+        data.pop()
+    data = [row[:width] + (None,) * (width - len(row)) for row in data]
+    return pd.DataFrame(data, columns=columns)
+
+
+def _is_blank(row: tuple) -> bool:
+    return all(value is None for value in row)
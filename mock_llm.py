@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import json
+import random
+import re
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Callable
+
+from agent import Message
+
+
+# A responder takes the list of messages from a chat completion request, and returns the text of the reply
+Responder = Callable[[list[Message]], str]
+
+
+def unsure_responder(messages: list[Message]) -> str:
+    return 'UNSURE'
+
+
+# (name keyword, answer) pairs, tried in order, for guessing the classification of a column from its name
+_NAME_ANSWERS = [
+    ('lat', ['GEO.LATITUDE', 'GEO', 'LATITUDE']),
+    ('lon', ['GEO.LONGITUDE', 'GEO', 'LONGITUDE']),
+    ('country', ['GEO.ISO3', 'GEO', 'ISO3', 'COUNTRY']),
+    ('year', ['DATE.YEAR', 'DATE', 'YEAR']),
+    ('date', ['DATE.DATE', 'DATE']),
+    ('time', ['DATE.TIME', 'DATE']),
+]
+
+
+def _pick_option(name: str, options: list[str]) -> str:
+    name = name.lower()
+    for keyword, answers in _NAME_ANSWERS:
+        if keyword in name:
+            for answer in answers:
+                if answer in options:
+                    return answer
+    for fallback in ('FEATURE.FLOAT', 'FEATURE', 'FLOAT'):
+        if fallback in options:
+            return fallback
+    return options[0]
+
+
+def annotation_responder(messages: list[Message]) -> str:
+    """
+    Canned, always-valid answers to the annotator's prompts, so that whole pipelines can run against the mock server.
+    Column classifications are guessed from the column name
+    """
+    text = '\n'.join(m['content'] for m in messages if m['role'] != 'assistant')
+    structured = re.search(r'JSON object with the keys (\[.*?\]), where each value is an object matching this JSON schema:\n(.*)', text)
+    if structured:
+        keys, schema = json.loads(structured.group(1)), json.loads(structured.group(2))
+        return json.dumps({
+            key: {field: 'NONE' if field.startswith('units') else 'Synthetic values generated for benchmarking.' for field in schema['properties']}
+            for key in keys
+        })
+    options = re.search(r'following options: (.*?), or UNSURE', text)
+    if 'one line per column' in text and options:
+        columns = re.findall(r'^(\d+): "(.*?)"', text, re.MULTILINE)
+        return '\n'.join(f'{i}: {_pick_option(name, options.group(1).split(", "))}' for i, name in columns)
+    if options:
+        name = re.search(r'(?:column|variable) called "(.*?)"', text)
+        return _pick_option(name.group(1) if name else '', options.group(1).split(', '))
+    if 'single integer' in text:
+        return '0'
+    if '"LATLON" or "LONLAT"' in text:
+        return 'LATLON'
+    if 'strftime format' in text:
+        return '%Y-%m-%d'
+    if 'obvious units' in text:
+        return 'NONE'
+    return 'Synthetic values generated for benchmarking.'
+
+
+class _ThreadingHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # clients that stop reading a stream early hang up, which isn't an error worth a traceback
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class MockLLMServer:
+    """
+    Local stand-in for the OpenAI chat completions endpoint, for running the Agent without hitting the real API.
+
+    Responses come from `responder` (e.g. `annotation_responder` for canned answers to the annotator's prompts), after
+    a simulated `latency` with up to `jitter` seconds of random variation.
+
+    Usage:
+        with MockLLMServer() as server:
+            agent = Agent(model='gpt-4', base_url=server.base_url)
+            ...
+    """
+
+    def __init__(self, responder: Responder = unsure_responder, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.responder = responder
+        # each response is delayed by latency +/- up to jitter seconds, to simulate the real API
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.requests = 0
+        self._server = _ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self) -> MockLLMServer:
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> MockLLMServer:
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 so that clients can keep connections alive between requests
+            protocol_version = 'HTTP/1.1'
+            # otherwise small writes on a kept-alive connection stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.endswith('/chat/completions'):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server.requests += 1
+                content = server.responder(body['messages'])
+                delay = server.latency + server._random.uniform(-server.jitter, server.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                if body.get('stream'):
+                    try:
+                        include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+                        self._send_stream(body['model'], content, body['messages'] if include_usage else None)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # the client stopped reading early and closed the connection
+                        self.close_connection = True
+                else:
+                    self._send_completion(body['model'], content, body['messages'])
+
+            @staticmethod
+            def _usage(messages: list[Message], content: str) -> dict:
+                # rough token counts (~4 characters per token), so usage metrics aren't all zero
+                prompt_tokens = sum(len(m['content']) for m in messages) // 4
+                completion_tokens = len(content) // 4
+                return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+            def _send_completion(self, model: str, content: str, messages: list[Message]):
+                payload = json.dumps({
+                    'id': 'chatcmpl-mock',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': content},
+                        'finish_reason': 'stop',
+                    }],
+                    'usage': self._usage(messages, content),
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, model: str, content: str, usage_messages: list[Message] | None = None):
+                # like the real API, usage comes in a final chunk with no choices, if the request asked for it
+                # chunked transfer encoding so the connection can be reused after the stream ends
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                words = content.split(' ')
+                deltas = [w if i == 0 else f' {w}' for i, w in enumerate(words)]
+                for delta in [*deltas, None]:
+                    chunk = {
+                        'id': 'chatcmpl-mock',
+                        'object': 'chat.completion.chunk',
+                        'created': int(time.time()),
+                        'model': model,
+                        'choices': [{
+                            'index': 0,
+                            'delta': {'content': delta} if delta is not None else {},
+                            'finish_reason': None if delta is not None else 'stop',
+                        }],
+                    }
+                    self._write_chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                if usage_messages is not None:
+                    chunk = {
+                        'id': 'chatcmpl-mock',
+                        'object': 'chat.completion.chunk',
+                        'created': int(time.time()),
+                        'model': model,
+                        'choices': [],
+                        'usage': self._usage(usage_messages, content),
+                    }
+                    self._write_chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                self._write_chunk(b'data: [DONE]\n\n')
+                self._write_chunk(b'')
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import re
+import numpy as np
+import pandas as pd
+from difflib import SequenceMatcher
+
+from heuristics import LAT_NAMES, LON_NAMES, YEAR_NAMES, MONTH_NAMES, DAY_NAMES
+from MetadataSchema import DateType
+
+
+# scores closer than this to the best alternative are considered ties, and left for the LLM to decide
+TIE_MARGIN = 0.05
+
+DATE_PART_NAMES = {
+    DateType.YEAR: YEAR_NAMES,
+    DateType.MONTH: MONTH_NAMES,
+    DateType.DAY: DAY_NAMES,
+}
+
+
+def name_stem(name: str, role_names: set[str]) -> str:
+    """
+    The part of a column name that isn't about its role in a pair/group, e.g. 'origin' for 'origin_lat' or 'OriginLat',
+    and 'd' for 'dlon'. Columns that go together usually share a stem
+    """
+    tokens = []
+    for token in _ordered_tokens(name):
+        if token in role_names:
+            continue
+        for role in sorted(role_names, key=len, reverse=True):
+            if len(role) >= 3 and token.endswith(role):
+                token = token[:-len(role)]
+                break
+            if len(role) >= 3 and token.startswith(role):
+                token = token[len(role):]
+                break
+        if token:
+            tokens.append(token)
+    return '_'.join(tokens)
+
+
+def _ordered_tokens(name: str) -> list[str]:
+    # same split as heuristics.name_tokens, but keeping the order of the words
+    name = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(name))
+    return [t for t in re.split(r'[^a-zA-Z0-9]+', name.lower()) if t]
+
+
+def name_similarity(a: str, b: str, a_roles: set[str], b_roles: set[str]) -> float:
+    stem_a, stem_b = name_stem(a, a_roles), name_stem(b, b_roles)
+    if stem_a == stem_b:
+        return 1.0
+    return SequenceMatcher(None, stem_a, stem_b).ratio()
+
+
+def null_alignment(a: pd.Series, b: pd.Series) -> float:
+    """fraction of rows where the columns are either both missing or both present"""
+    return float((a.isna().to_numpy() == b.isna().to_numpy()).mean()) if len(a) else 1.0
+
+
+def co_occurrence(a: pd.Series, b: pd.Series) -> float:
+    """of the rows where either column has a value, the fraction where both do"""
+    a_present, b_present = a.notna().to_numpy(), b.notna().to_numpy()
+    either = (a_present | b_present).sum()
+    return float((a_present & b_present).sum() / either) if either else 1.0
+
+
+def _decimals(series: pd.Series) -> float:
+    values = series.dropna().astype(str).head(1000)
+    if values.empty:
+        return 0.0
+    return float(values.str.partition('.')[2].str.len().median())
+
+
+def latlon_score(lat: pd.Series, lon: pd.Series) -> float:
+    """How likely the two columns are to be a latitude/longitude pair, from 0 to 1"""
+    lat_values, lon_values = pd.to_numeric(lat, errors='coerce'), pd.to_numeric(lon, errors='coerce')
+    in_range = float(lat_values.abs().max() <= 90) * 0.5 + float(lon_values.min() >= -180 and lon_values.max() <= 360) * 0.5
+    precision = 1 - min(abs(_decimals(lat) - _decimals(lon)), 5) / 5
+    return (
+        0.5 * name_similarity(str(lat.name), str(lon.name), LAT_NAMES, LON_NAMES)
+        + 0.15 * null_alignment(lat, lon)
+        + 0.15 * co_occurrence(lat, lon)
+        + 0.1 * in_range
+        + 0.1 * precision
+    )
+
+
+def date_part_score(a: pd.Series, a_type: DateType, b: pd.Series, b_type: DateType) -> float:
+    """How likely two year/month/day columns are to be parts of the same date, from 0 to 1"""
+    return (
+        0.6 * name_similarity(str(a.name), str(b.name), DATE_PART_NAMES[a_type], DATE_PART_NAMES[b_type])
+        + 0.2 * null_alignment(a, b)
+        + 0.2 * co_occurrence(a, b)
+    )
+
+
+def assign(scores: np.ndarray) -> list[tuple[int, int]]:
+    """
+    The one-to-one matching of rows to columns with the highest total score (Hungarian algorithm).
+    If the matrix isn't square, the extra rows/columns are left unmatched
+    """
+    if scores.size == 0:
+        return []
+    transposed = scores.shape[0] > scores.shape[1]
+    cost = -(scores.T if transposed else scores)
+    n, m = cost.shape
+
+    # potentials u/v, p[j] = row matched to column j (1-based, 0 = none), way[j] = previous column on the augmenting path
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p, way = np.zeros(m + 1, dtype=int), np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        min_v = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0, delta, j1 = p[j0], np.inf, 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = cost[i0 - 1, j - 1] - u[i0] - v[j]
+                    if cur < min_v[j]:
+                        min_v[j], way[j] = cur, j0
+                    if min_v[j] < delta:
+                        delta, j1 = min_v[j], j
+            u[p[used]] += delta
+            v[used] -= delta
+            min_v[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    matches = [(p[j] - 1, j - 1) for j in range(1, m + 1) if p[j] != 0]
+    return sorted((c, r) for r, c in matches) if transposed else sorted(matches)
+
+
+def _is_tie(scores: np.ndarray, i: int, j: int, margin: float) -> bool:
+    """whether row i or column j has an alternative scoring within margin of their match"""
+    alternatives = [*np.delete(scores[i], j), *np.delete(scores[:, j], i)]
+    return bool(alternatives) and max(alternatives) >= scores[i, j] - margin
+
+
+def pair_latlon(df: pd.DataFrame, lat_cols: list[str], lon_cols: list[str], margin: float = TIE_MARGIN) -> tuple[list[tuple[str, str]], list[str], list[str]]:
+    """
+    Match latitude columns to longitude columns by score (see `latlon_score`), maximizing the total score.
+
+    Returns (pairs as (lat, lon), unresolved, unpaired). Unresolved columns are those whose match was a tie with an
+    alternative, to be decided some other way (i.e. by the LLM). Unpaired columns have no counterpart left over.
+    """
+    scores = np.array([[latlon_score(df[lat], df[lon]) for lon in lon_cols] for lat in lat_cols]).reshape(len(lat_cols), len(lon_cols))
+    pairs, unresolved = [], []
+    for i, j in assign(scores):
+        if _is_tie(scores, i, j, margin):
+            unresolved += [lat_cols[i], lon_cols[j]]
+        else:
+            pairs.append((lat_cols[i], lon_cols[j]))
+    matched = {col for pair in pairs for col in pair} | set(unresolved)
+    unpaired = [col for col in [*lat_cols, *lon_cols] if col not in matched]
+    return pairs, unresolved, unpaired
+
+
+def group_date_parts(df: pd.DataFrame, date_types: dict[str, DateType], margin: float = TIE_MARGIN) -> tuple[list[tuple[str, ...]], list[str], list[str]]:
+    """
+    Group year/month/day columns into dates, by matching each part type in turn (years, then months, then days) to
+    the groups so far, maximizing the total score (see `date_part_score`, averaged over a group's columns).
+
+    Returns (groups, unresolved, ungrouped) like `pair_latlon`. Each group lists its columns from year to day.
+    """
+    groups: list[tuple[str, ...]] = []
+    unresolved: list[str] = []
+    for part in (DateType.YEAR, DateType.MONTH, DateType.DAY):
+        cols = [col for col, date_type in date_types.items() if date_type == part]
+        scores = np.array([
+            [np.mean([date_part_score(df[member], date_types[member], df[col], part) for member in group]) for col in cols]
+            for group in groups
+        ]).reshape(len(groups), len(cols))
+        matches = assign(scores)
+        matched_groups, matched_cols = {i for i, _ in matches}, {j for _, j in matches}
+        next_groups = []
+        for i, j in matches:
+            if _is_tie(scores, i, j, margin):
+                unresolved += [*groups[i], cols[j]]
+            else:
+                next_groups.append((*groups[i], cols[j]))
+        next_groups += [group for i, group in enumerate(groups) if i not in matched_groups]
+        # parts left over start groups of their own, e.g. a month/day date without a year
+        next_groups += [(col,) for j, col in enumerate(cols) if j not in matched_cols]
+        groups = next_groups
+
+    ungrouped = [group[0] for group in groups if len(group) == 1]
+    groups = [group for group in groups if len(group) > 1]
+    return groups, unresolved, ungrouped
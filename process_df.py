@@ -2,9 +2,18 @@ from __future__ import annotations
 
 from agent import Message, Role, Agent
 from meta import Meta
+from loaders import LazyCsv, sample_csv, sample_excel, list_sheets, dedup_names, SamplingMethod
+from profiler import profile_df, ColumnProfile
+from heuristics import guess_columns
+from pairing import pair_latlon, group_date_parts
+from fingerprint import AnnotationStore, column_signature, schema_fingerprint
+from date_formats import rank_strftime_formats, distinct_interpretations, as_date_strings, format_parse_ratio, unparsed_values, MIN_PARSE_RATIO
+import numpy as np
 import pandas as pd
+import re
 from typing import TypeVar
-from utils import enum_to_keys, ask_user, inplace_replace, is_valid_strftime_format
+from instrument import StageTimer
+from utils import enum_to_keys, ask_user, inplace_replace, is_valid_strftime_format, map_concurrent
 
 from MetadataSchema import (
     AnnotationSchema,
@@ -20,25 +29,112 @@ from MetadataSchema import (
     TimeField,
     LatLong,
     TimeRange,
+    MetaModel,
 )
 
+from pydantic import BaseModel, Field
+
 import pdb
 
 
-def handle_csv(meta: Meta, agent: Agent) -> AnnotationSchema:
-    df = pd.read_csv(meta.path)
-    return handle_df(df, meta, agent)
+class FeatureDetails(BaseModel):
+    """What the LLM fills in for each feature column, in one structured response"""
+    units: str = Field(min_length=1, description='The units of the column if obvious from the dataset description, column name or values, written e.g. as W/m^2 for watts per meter squared. NONE if units are not relevant, or UNSURE if unsure')
+    units_description: str = Field(min_length=1, description='A brief one-line description of the units, or NONE/UNSURE to match units')
+    description: str = Field(min_length=1, description='A brief description of the column, without referring to the column itself')
+
+
+class ColumnDescription(BaseModel):
+    description: str = Field(min_length=1, description='A brief description of the column, without referring to the column itself')
+
+
+def handle_csv(meta: Meta, agent: Agent, max_workers: int = 1, batch_size: int | None = None, sample_rows: int | None = 10_000, sampling: SamplingMethod = 'head', heuristic_threshold: float | None = 0.9, store: AnnotationStore | None = None, flat_taxonomy: bool = False, previous: AnnotationSchema | MetaModel | None = None, previous_signatures: dict[str, str] | None = None) -> AnnotationSchema:
+    """
+    Annotate a CSV file. Only a sample of at most `sample_rows` rows is read (see `loaders.sample_csv`),
+    unless `sample_rows` is None, in which case the whole file is loaded. Later stages read more of the file only where
+    the sample isn't enough (see the `csv` argument of `handle_df`).
+    If the `previous` annotations of the file are given, only its new or changed columns are annotated from scratch
+    (see `handle_df_incremental`), compared against the `previous_signatures` saved with them if given.
+    """
+    if sample_rows is None:
+        df, csv = pd.read_csv(meta.path), None
+    else:
+        csv = sample_csv(meta.path, sample_rows, sampling)
+        df = csv.sample
+    if previous is not None:
+        return handle_df_incremental(df, meta, agent, previous, previous_signatures, max_workers=max_workers, batch_size=batch_size, heuristic_threshold=heuristic_threshold, flat_taxonomy=flat_taxonomy, csv=csv)
+    return handle_df(df, meta, agent, max_workers=max_workers, batch_size=batch_size, heuristic_threshold=heuristic_threshold, store=store, flat_taxonomy=flat_taxonomy, csv=csv)
+
+
+def handle_xlsx(meta: Meta, agent: Agent, max_workers: int = 1, batch_size: int | None = None, sample_rows: int | None = 10_000, heuristic_threshold: float | None = 0.9, store: AnnotationStore | None = None, sheet: str | int = 0, flat_taxonomy: bool = False, previous: AnnotationSchema | MetaModel | None = None, previous_signatures: dict[str, str] | None = None) -> AnnotationSchema:
+    """
+    Annotate one sheet (the first by default) of an Excel workbook. Only the header and at most `sample_rows` rows are
+    read (see `read_sheet`), unless `sample_rows` is None, in which case every row is read.
+    `previous` annotations are reused as in `handle_csv`.
+    """
+    df = read_sheet(meta, sheet, sample_rows)
+    if previous is not None:
+        return handle_df_incremental(df, meta, agent, previous, previous_signatures, max_workers=max_workers, batch_size=batch_size, heuristic_threshold=heuristic_threshold, flat_taxonomy=flat_taxonomy)
+    return handle_df(df, meta, agent, max_workers=max_workers, batch_size=batch_size, heuristic_threshold=heuristic_threshold, store=store, flat_taxonomy=flat_taxonomy)
 
 
-def handle_xlsx(meta: Meta, agent: Agent) -> AnnotationSchema:
-    df = pd.read_excel(meta.path)
-    return handle_df(df, meta, agent)
+def read_sheet(meta: Meta, sheet: str | int = 0, sample_rows: int | None = 10_000) -> pd.DataFrame:
+    """
+    `loaders.sample_excel`, with the column names as strings (annotations name columns by str), e.g. '2020' for a year
+    header. Names that collide once stringified (2020 and '2020') are deduplicated again
+    """
+    df = sample_excel(meta.path, sheet, sample_rows)
+    df.columns = dedup_names([str(col) for col in df.columns])
+    return df
+
+
+def handle_xlsx_sheets(meta: Meta, agent: Agent, sheet_workers: int = 4, **options) -> dict[str, AnnotationSchema]:
+    """
+    Annotate every sheet of an Excel workbook, up to `sheet_workers` sheets at a time.
+    `options` are passed to `handle_xlsx`. Returns the annotations per sheet name, in workbook order
+    """
+    sheets = list_sheets(meta.path)
+
+    def handle_sheet(sheet: str) -> AnnotationSchema:
+        sheet_meta = Meta(meta.path, f'{meta.name} (sheet "{sheet}")', meta.description)
+        return handle_xlsx(sheet_meta, agent, sheet=sheet, **options)
+
+    return dict(zip(sheets, map_concurrent(handle_sheet, sheets, sheet_workers)))
 
 
 T = TypeVar('T')
 
 
-def identify_column_type(agent: Agent, df: pd.DataFrame, col: str, meta: Meta, options: list[T], prompt: str) -> T | None:
+def flat_type_options() -> list[str]:
+    """Every column type and subtype as a single option, e.g. GEO.LATITUDE (plus DATE.TIME for time-like columns)"""
+    return [
+        *[f'DATE.{date_type}' for date_type in enum_to_keys(DateType) + ['TIME']],
+        *[f'GEO.{geo_type}' for geo_type in enum_to_keys(GeoType)],
+        *[f'FEATURE.{feature_type}' for feature_type in enum_to_keys(FeatureType)],
+    ]
+
+
+def split_flat_type(answer: str | None) -> tuple[str | None, str | None]:
+    """(column type, subtype) keys for an answer from `flat_type_options`, e.g. ('GEO', 'LATITUDE')"""
+    if answer is None:
+        return None, None
+    col_type, subtype = answer.split('.', 1)
+    if col_type == 'DATE' and subtype == 'TIME':
+        subtype = 'DATE'  # metadata currently treats times as just DATE
+    return col_type, subtype
+
+
+def annotation_subtype(annotation: GeoAnnotation | DateAnnotation | FeatureAnnotation) -> str:
+    """the subtype key of an annotation, e.g. 'LATITUDE'"""
+    if isinstance(annotation, GeoAnnotation):
+        return annotation.geo_type.name
+    if isinstance(annotation, DateAnnotation):
+        return annotation.date_type.name
+    return annotation.feature_type.name
+
+
+def identify_column_type(agent: Agent, summary: str, col: str, meta: Meta, options: list[T], prompt: str) -> T | None:
+    """Ask the LLM to classify the column into one of the options. `summary` describes the column's values for the prompt"""
     options_or_unsure = options + ['UNSURE']
     options_or_none = options + ['NONE']
 
@@ -48,23 +144,24 @@ def identify_column_type(agent: Agent, df: pd.DataFrame, col: str, meta: Meta, o
         Message(Role.user, f'''\
 I have a dataset called "{meta.name}" with the following description:
 "{meta.description}"
-I have a column called "{col}" with the following values (first 5 rows):
-{df[col].head().to_string()}
+I have a column called "{col}" with the following profile:
+{summary}
 {prompt}
 Please select one of the following options: {', '.join(options)}, or UNSURE. Write your answer without any other comments.\
 '''
                 )
     ]
 
-    # ask the model to identify the type of the column
-    res = agent.multishot_sync(messages)
+    # ask the model to identify the type of the column. The answer is only ever one of the options, so it's streamed
+    # and cut off as soon as it's unambiguous
+    res = agent.choose(messages, options_or_unsure)
 
     # reprompt the LLM if it didn't give a valid answer
     if res not in options_or_unsure:
         messages.append(Message(Role.assistant, res))
         messages.append(Message(
             Role.system, f'`{res}` is not a valid answer. Please select one of the following options: {", ".join(options)}, or UNSURE. Write your answer without any other comments.'))
-        res = agent.multishot_sync(messages)
+        res = agent.choose(messages, options_or_unsure)
 
     # if it failed a second time, just set it to UNSURE
     if res not in options_or_unsure:
@@ -73,8 +170,8 @@ Please select one of the following options: {', '.join(options)}, or UNSURE. Wri
     # have the user fill in the answer if the LLM was unsure or failed twice
     while res not in options_or_none:
         res = ask_user(f'''\
-The LLM was unsure about the date type for "{col}" with the following values (first 5 rows):
-{df[col].head().to_string()}
+The LLM was unsure about the date type for "{col}" with the following profile:
+{summary}
 {prompt=}
 Select one of the following options: {', '.join(options)} or None: \
 ''')
@@ -87,61 +184,320 @@ Select one of the following options: {', '.join(options)} or None: \
     return res
 
 
-def handle_df(df: pd.DataFrame, meta: Meta, agent: Agent) -> AnnotationSchema:
+def identify_column_types_batched(agent: Agent, summaries: dict[str, str], cols: list[str], meta: Meta, options: list[T], prompt: str, batch_size: int = 10, max_workers: int = 1) -> dict[str, T | None]:
+    """
+    Classify several columns per LLM request.
+
+    Each request packs up to `batch_size` columns (and their value summaries) into a single prompt, and the answers are
+    parsed back per column. Only columns whose answer is missing, invalid or UNSURE fall back to `identify_column_type`.
+    """
+    batches = [cols[i:i + batch_size] for i in range(0, len(cols), batch_size)]
+
+    def classify_batch(batch: list[str]) -> dict[str, T]:
+        columns_str = '\n'.join([f'{i}: "{col}" with profile:\n{summaries[col]}' for i, col in enumerate(batch)])
+        response = agent.oneshot_sync('You are a helpful assistant.', f'''\
+I have a dataset called "{meta.name}" with the following description:
+"{meta.description}"
+I have the following columns:
+{columns_str}
+For each column independently:
+{prompt}
+For each column, please select one of the following options: {', '.join(options)}, or UNSURE. Write your answer as one line per column in the form `<index>: <option>` (e.g. `0: {options[0]}`), without any other comments.\
+'''
+                                      )
+        answers = {}
+        for line in response.splitlines():
+            match = re.match(r'^\W*(\d+)\W*[:.)-]\W*(\w+(?:\.\w+)?)', line)
+            if match is None:
+                continue
+            i, answer = int(match.group(1)), match.group(2).upper()
+            if 0 <= i < len(batch) and answer in options:
+                answers[batch[i]] = answer
+        return answers
+
+    answers: dict[str, T] = {}
+    for batch_answers in map_concurrent(classify_batch, batches, max_workers):
+        answers.update(batch_answers)
+
+    # fall back to classifying one at a time for any columns that didn't get a valid answer
+    missing = [col for col in cols if col not in answers]
+    if missing:
+        print(f'LLM gave no valid batched answer for {len(missing)} column(s), retrying individually: {missing}')
+    fallback = map_concurrent(lambda col: identify_column_type(agent, summaries[col], col, meta, options, prompt), missing, max_workers)
+
+    return {**answers, **dict(zip(missing, fallback))}
+
+
+def df_signatures(df: pd.DataFrame) -> dict[str, str]:
+    """the signature (see `fingerprint.column_signature`) of each column of the dataframe"""
+    return {col: column_signature(profile) for col, profile in profile_df(df).items()}
+
+
+def table_signatures(meta: Meta, sample_rows: int | None = 10_000, sampling: SamplingMethod = 'head', sheet: str | int = 0) -> dict[str, str]:
+    """
+    The column signatures of a CSV or Excel file, from the same sample that `handle_csv`/`handle_xlsx` annotate.
+    Saved with the annotations, they let `handle_df_incremental` tell exactly which columns changed in a later version
+    """
+    if meta.path.suffix == '.xlsx':
+        df = read_sheet(meta, sheet, sample_rows)
+    elif sample_rows is None:
+        df = pd.read_csv(meta.path)
+    else:
+        df = sample_csv(meta.path, sample_rows, sampling).sample
+    return df_signatures(df)
+
+
+def handle_df_deduplicated(df: pd.DataFrame, meta: Meta, agent: Agent, store: AnnotationStore, **options) -> AnnotationSchema:
+    """
+    Annotate the dataframe, reusing previous annotations from the store where the schema matches.
+
+    If a dataset with the same schema fingerprint was annotated before, its AnnotationSchema is returned as is.
+    Otherwise, if a stored dataset shares most column signatures, its annotations are kept for the matching columns,
+    and only the differing columns are annotated (see `handle_df_incremental`). `options` are passed on to handle_df.
+    """
+    signatures = df_signatures(df)
+    fingerprint = schema_fingerprint(signatures)
+
+    with store.claim(fingerprint):
+        stored = store.get(fingerprint)
+        if stored is not None:
+            print(f'Reusing annotations from "{stored.source}", which has the same schema fingerprint')
+            return stored.annotations
+
+        similar = store.find_similar(signatures)
+        if similar is None:
+            annotations = handle_df(df, meta, agent, **options)
+        else:
+            print(f'Reusing annotations from "{similar.source}", which has a similar schema')
+            annotations = handle_df_incremental(df, meta, agent, similar.annotations, similar.signatures, **options)
+
+        store.put(signatures, annotations, str(meta.path))
+
+    return annotations
+
+
+def feature_type_from_dtype(dtype: np.dtype) -> FeatureType:
+    if dtype.kind == 'b':
+        return FeatureType.BOOLEAN
+    if dtype.kind in 'iu':
+        return FeatureType.INT
+    if dtype.kind == 'f':
+        return FeatureType.FLOAT
+    return FeatureType.STR
+
+
+# date parts that are numbers, and the range of their values (None if unbounded)
+NUMERIC_DATE_PARTS = {
+    DateType.YEAR: None,
+    DateType.MONTH: (1, 12),
+    DateType.DAY: (1, 31),
+    DateType.EPOCH: None,
+}
+
+
+def still_matches(annotation: GeoAnnotation | DateAnnotation | FeatureAnnotation, profile: ColumnProfile, values: pd.Series) -> bool:
+    """
+    Whether a column's dtype and values are still consistent with its previous annotation, e.g. still a float column
+    for a FLOAT feature, or still text for a country column. Used when there are no previous column signatures to
+    compare against, so it errs on the side of re-annotating columns it can't check
+    """
+    numeric = values.dtype.kind in 'iuf'
+    if isinstance(annotation, FeatureAnnotation):
+        if annotation.feature_type in (FeatureType.BINARY, FeatureType.BOOLEAN):
+            # e.g. True/False, 0/1 or yes/no
+            return profile.n_unique <= 2
+        return feature_type_from_dtype(values.dtype) == annotation.feature_type
+    if isinstance(annotation, GeoAnnotation):
+        if annotation.geo_type == GeoType.LATITUDE:
+            return numeric and profile.count > 0 and -90 <= profile.min and profile.max <= 90
+        if annotation.geo_type == GeoType.LONGITUDE:
+            return numeric and profile.count > 0 and -180 <= profile.min and profile.max <= 360
+        # names, codes and coordinate strings
+        return not numeric
+    if annotation.date_type in NUMERIC_DATE_PARTS and annotation.time_format == 'todo':
+        bounds = NUMERIC_DATE_PARTS[annotation.date_type]
+        if not numeric:
+            # only months are also written out as text, e.g. Jan
+            return annotation.date_type == DateType.MONTH
+        return bounds is None or (profile.count > 0 and bounds[0] <= profile.min and profile.max <= bounds[1])
+    if not is_valid_strftime_format(annotation.time_format):
+        return False
+    return format_parse_ratio(as_date_strings(values), annotation.time_format) >= MIN_PARSE_RATIO
+
+
+def handle_df_incremental(df: pd.DataFrame, meta: Meta, agent: Agent, previous: AnnotationSchema | MetaModel, previous_signatures: dict[str, str] | None = None, **options) -> AnnotationSchema:
+    """
+    Re-annotate a dataframe that was annotated before (e.g. a refresh with appended rows or new columns).
+
+    Columns are diffed against the `previous` annotations by name, dtype and value profile: against the
+    `previous_signatures` (see `fingerprint.column_signature`) if given, and otherwise by checking the values still fit
+    the annotation (see `still_matches`). Unchanged columns keep their types, formats, units and descriptions, so only
+    the added or changed columns go through the LLM passes. Pairing, grouping and primary selection are redone over
+    all the columns. `options` are passed on to handle_df.
+    """
+    if isinstance(previous, MetaModel):
+        previous = previous.annotations or AnnotationSchema(geo=[], date=[], feature=[])
+    annotations = {a.name: a for a in [*(previous.geo or []), *(previous.date or []), *(previous.feature or [])]}
+    profiles = profile_df(df)
+
+    def unchanged(col: str) -> bool:
+        if col not in annotations:
+            return False
+        if previous_signatures is not None:
+            return previous_signatures.get(col) == column_signature(profiles[col])
+        return still_matches(annotations[col], profiles[col], df[col])
+
+    same = {col for col in df.columns if unchanged(col)}
+    changed = [col for col in df.columns if col not in same]
+    print(f'Keeping annotations for {len(same)} unchanged column(s), annotating {changed}')
+    known = AnnotationSchema(
+        geo=[a for a in previous.geo or [] if a.name in same],
+        date=[a for a in previous.date or [] if a.name in same],
+        feature=[a for a in previous.feature or [] if a.name in same],
+    )
+    return handle_df(df, meta, agent, known=known, **options)
+
+
+def handle_df(df: pd.DataFrame, meta: Meta, agent: Agent, max_workers: int = 1, batch_size: int | None = None, heuristic_threshold: float | None = 0.9, store: AnnotationStore | None = None, flat_taxonomy: bool = False, known: AnnotationSchema | None = None, csv: LazyCsv | None = None) -> AnnotationSchema:
+    """
+    Annotate each column of the dataframe.
+
+    Independent per-column LLM calls within each pass are sent concurrently using up to `max_workers` threads.
+    Results are always collected in column order, so the output does not depend on `max_workers`.
+    If `batch_size` is given, the column type passes classify, and the description pass describes, up to `batch_size`
+    columns per LLM request.
+    Columns that the rules in `heuristics` classify with at least `heuristic_threshold` confidence skip the LLM
+    type passes entirely. Set `heuristic_threshold` to None to send every column to the LLM.
+    If a `store` is given, annotations of previously seen schemas are reused (see `handle_df_deduplicated`).
+    With `flat_taxonomy`, each column's type and subtype are picked together in one pass (see `flat_type_options`),
+    rather than in two passes one after the other.
+    `known` annotations (of columns unchanged since a previous run, see `handle_df_incremental`) are kept as they are,
+    except for their pairs, groups and primaries, which are redone along with the rest of the columns.
+    If df is a sample of the `csv` file, columns with no values in the sample are profiled and classified from the whole
+    file instead, and date formats that the sample can't tell apart (e.g. no day past the 12th yet) are checked against
+    the whole column.
+    """
+    if store is not None:
+        return handle_df_deduplicated(df, meta, agent, store, max_workers=max_workers, batch_size=batch_size, heuristic_threshold=heuristic_threshold, flat_taxonomy=flat_taxonomy, csv=csv)
+
+    stage = StageTimer(agent.metrics)
+
+    stage('profiling')
+    # profile every column once up front. All prompts show the model these summaries rather than raw rows
+    profiles = profile_df(df)
+    empty = [col for col, profile in profiles.items() if profile.count == 0]
+    loaded = csv.columns(empty) if csv is not None and empty else None
+    if loaded is not None:
+        print(f'No values in the sample for {empty}, profiling them from the whole file')
+        profiles.update(profile_df(loaded))
+    summaries = {col: profile.to_prompt() for col, profile in profiles.items()}
+
+    def values(col: str) -> pd.Series:
+        """the column's values in the sample, or in the whole file for columns with none in the sample"""
+        return loaded[col] if loaded is not None and col in loaded else df[col]
+
+    def classify_columns(cols: list[str], options: list[str], prompt: str) -> list[str | None]:
+        """classify each of the columns, returning the answers in the same order as cols"""
+        if batch_size is not None:
+            answers = identify_column_types_batched(agent, summaries, cols, meta, options, prompt, batch_size, max_workers)
+            return [answers[col] for col in cols]
+        return map_concurrent(lambda col: identify_column_type(agent, summaries[col], col, meta, options, prompt), cols, max_workers)
+
+    stage('column typing')
+    # classify the obvious columns without the LLM
+    known_annotations = {a.name: a for a in [*(known.geo or []), *(known.date or []), *(known.feature or [])]} if known is not None else {}
+    guesses = {}
+    if heuristic_threshold is not None:
+        guesses = guess_columns(df.drop(columns=empty) if loaded is not None else df, profiles, heuristic_threshold)
+        if loaded is not None:
+            guesses.update(guess_columns(loaded, profiles, heuristic_threshold))
+    guesses = {col: guess for col, guess in guesses.items() if col not in known_annotations}
+    for col, guess in guesses.items():
+        print(f'Heuristics identified column "{col}" as a {guess.column_type}/{guess.subtype} ({guess.reason}, confidence={guess.confidence:.2f})')
+    subtype_map = {col: guess.subtype for col, guess in guesses.items()}
+    subtype_map.update({col: annotation_subtype(a) for col, a in known_annotations.items()})
+
     # map from all ColumnType keys to empty lists
     column_type_map = {col_type.name: [] for col_type in ColumnType}
 
-    for col in df.columns:
-        col_type = identify_column_type(
-            agent, df, col, meta,
+    unknown_cols = [col for col in df.columns if col not in guesses and col not in known_annotations]
+    if flat_taxonomy:
+        # pick the subtype at the same time, so the subtype passes below have nothing left to ask
+        answers = classify_columns(
+            unknown_cols,
+            flat_type_options(),
+            'I need to determine if this column contains geographic information, date/time information, or feature information, and the type of information it contains. If it is not obviously geo or time related, then it is probably a feature column. Time-like columns are DATE.TIME.'
+        )
+        col_types = []
+        for col, answer in zip(unknown_cols, answers):
+            print(f'LLM identified column "{col}" as a {answer}')
+            col_type, subtype = split_flat_type(answer)
+            col_types.append(col_type)
+            if subtype is not None:
+                subtype_map[col] = subtype
+    else:
+        col_types = classify_columns(
+            unknown_cols,
             enum_to_keys(ColumnType),
             'I need to determine if this column contains geographic information, date/time information, or feature information. If it is not obviously geo or time related, then it is probably a feature column.'
         )
-        print(f'LLM identified column "{col}" as a {col_type}')
-        column_type_map[col_type].append(col)
+        for col, col_type in zip(unknown_cols, col_types):
+            print(f'LLM identified column "{col}" as a {col_type}')
+    col_types = {
+        **dict(zip(unknown_cols, col_types)),
+        **{col: guess.column_type for col, guess in guesses.items()},
+        **{col: a.type.name for col, a in known_annotations.items()},
+    }
+    for col in df.columns:
+        if col_types[col] is not None:
+            column_type_map[col_types[col]].append(col)
 
+    stage('subtypes')
     # determine the type of date column for each
-    date_type_map = {}
-    for col in column_type_map['DATE']:
-        date_type = identify_column_type(
-            agent, df, col, meta,
-            # give the LLM an option for time-like columns, which we will treat as DATE
-            enum_to_keys(DateType) + ['TIME'],
-            '''\
+    date_type_map = {col: subtype_map[col] for col in column_type_map['DATE'] if col in subtype_map}
+    unknown_cols = [col for col in column_type_map['DATE'] if col not in date_type_map]
+    date_types = classify_columns(
+        unknown_cols,
+        # give the LLM an option for time-like columns, which we will treat as DATE
+        enum_to_keys(DateType) + ['TIME'],
+        '''\
 The column has been identified as containing date/time information.
 I need to identify the type of date/time information it contains.\
-            '''
-        )
+        '''
+    )
+    for col, date_type in zip(unknown_cols, date_types):
         if date_type == 'TIME':
             date_type = 'DATE'  # metadata currently treats times as just DATE
         print(f'LLM identified DATE column "{col}" as a {date_type}')
         date_type_map[col] = date_type
 
     # identifying the type of geo column for each
-    geo_type_map = {}
-    for col in column_type_map['GEO']:
-        geo_type = identify_column_type(
-            agent, df, col, meta,
-            enum_to_keys(GeoType),
-            '''\
+    geo_type_map = {col: subtype_map[col] for col in column_type_map['GEO'] if col in subtype_map}
+    unknown_cols = [col for col in column_type_map['GEO'] if col not in geo_type_map]
+    geo_types = classify_columns(
+        unknown_cols,
+        enum_to_keys(GeoType),
+        '''\
 The column has been identified as containing geographic information.
 I need to identify the type of geographic information it contains.\
-            '''
-        )
+        '''
+    )
+    for col, geo_type in zip(unknown_cols, geo_types):
         print(f'LLM identified GEO column "{col}" as a {geo_type}')
         geo_type_map[col] = geo_type
 
     # identifying the type of feature column for each
-    feature_type_map = {}
-    for col in column_type_map['FEATURE']:
-        feature_type = identify_column_type(
-            agent, df, col, meta,
-            enum_to_keys(FeatureType),
-            '''\
+    feature_type_map = {col: subtype_map[col] for col in column_type_map['FEATURE'] if col in subtype_map}
+    unknown_cols = [col for col in column_type_map['FEATURE'] if col not in feature_type_map]
+    feature_types = classify_columns(
+        unknown_cols,
+        enum_to_keys(FeatureType),
+        '''\
 The column has been identified as containing feature information.
 I need to identify the type of feature information it contains.\
-            '''
-        )
+        '''
+    )
+    for col, feature_type in zip(unknown_cols, feature_types):
         print(f'LLM identified FEATURE column "{col}" as a {feature_type}')
         feature_type_map[col] = feature_type
 
@@ -202,62 +558,35 @@ I need to identify the type of feature information it contains.\
                 qualifierrole=None,
             ))
 
-    # identify the units of feature columns if any
-    for feature in feature_annotations:
-        response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{feature.name}" with the following values (first 5 rows):
-{df[feature.name].head().to_string()}
-I need to identify if this column has any obvious units (made clear either from the dataset description, column name or column values).
-Without any other comments, please provide the units for this feature column, NONE if units are not relevant, or UNSURE if you are unsure. E.g. if the unit was watts per meter squared, your answer should just be the string W/m^2\
-'''
-                                      )
-        if response == 'NONE':
-            inplace_replace(
-                feature_annotations,
-                feature,
-                FeatureAnnotation(**{
-                    **feature.model_dump(),
-                    'units': 'N/A',
-                    'units_description': 'N/A'
-                })
-            )
-            print(f'LLM identified no units for feature column "{feature.name}"')
-            continue
-        if response == 'UNSURE':
-            print(f'LLM was unsure about the units for feature column "{feature.name}"')
-            continue
-
-        units = response
-        # come up with a description for the units
-        response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{feature.name}" with the following values (first 5 rows):
-{df[feature.name].head().to_string()}
-The column has been identified as containing feature information, and has been marked as a {feature.feature_type.name} column with units "{units}".
-I need a description for these units. Please provide a brief one-line description of the units for this column.
-'''
-                                      )
-        inplace_replace(
-            feature_annotations,
-            feature,
-            FeatureAnnotation(**{
-                **feature.model_dump(),
-                'units': units,
-                'units_description': response
-            })
-        )
-        print(f'LLM provided units and description for feature column "{feature.name}": {units}. {response}')
+    # keep everything already known about unchanged columns, except their pairs/groups/primaries, which are redone below
+    for col, annotation in known_annotations.items():
+        if col in geo_idxs:
+            geo_annotations[geo_idxs[col]] = annotation.model_copy(update={'primary_geo': None, 'is_geo_pair': None})
+        elif col in date_idxs:
+            date_annotations[date_idxs[col]] = annotation.model_copy(update={'primary_date': None, 'associated_columns': None})
+        elif col in feature_idxs:
+            feature_annotations[feature_idxs[col]] = annotation
 
+    stage('geo pairing')
     # identify geo lat/lon column pairs
-    latlon_columns: list[str] = []
+    lat_columns: list[str] = []
+    lon_columns: list[str] = []
     isolated_geo_columns: list[str] = []
     for geo in geo_annotations:
         # for groupings, matches in geo_type_sets:
-        if geo.geo_type == GeoType.LATITUDE or geo.geo_type == GeoType.LONGITUDE:
-            latlon_columns.append(geo.name)
+        if geo.geo_type == GeoType.LATITUDE:
+            lat_columns.append(geo.name)
+        elif geo.geo_type == GeoType.LONGITUDE:
+            lon_columns.append(geo.name)
         else:
             isolated_geo_columns.append(geo.name)
 
-    latlon_pairs: list[tuple[str, str]] = []
+    # pair by name similarity, value ranges and null patterns first. Only ties are left for the llm
+    latlon_pairs, latlon_columns, unpaired = pair_latlon(df, lat_columns, lon_columns)
+    isolated_geo_columns.extend(unpaired)
+    for pair in latlon_pairs:
+        print(f'Pairing scores identified coordinate pair: {pair}')
+
     geo_type_match_map = {
         GeoType.LATITUDE: GeoType.LONGITUDE,
         GeoType.LONGITUDE: GeoType.LATITUDE,
@@ -282,13 +611,13 @@ I need a description for these units. Please provide a brief one-line descriptio
 
         # else ask the llm to pick the best matching pair if any
         candidate_names = [i.name for i in candidates]
-        candidate_heads = [df[i.name].head().to_string() for i in candidates]
+        candidates_str = '\n'.join([f'{i}: "{c.name}" with profile:\n{summaries[c.name]}' for i, c in enumerate(candidates)])
         response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{cur.name}" with the following values (first 5 rows):
-{df[cur.name].head().to_string()}
+I'm looking at a dataset called "{meta.name}".  I have a column called "{cur.name}" with the following profile:
+{summaries[cur.name]}
 I'm trying to identify the column that should be paired with this coordinate column. Typically pairs will be identifiable by commonalities in the column name.
 I have the following candidates:
-{', '.join([ f'{i}:{name} with values {head}' for i, (name, head) in enumerate(zip(candidate_names, candidate_heads))])}
+{candidates_str}
 Without any other comments, please select the index of the most likely pair for the column "{cur.name}" from the list above, i.e. please output a single integer (0-{len(candidates)-1}) with your selection.
 '''
                                       )
@@ -302,14 +631,12 @@ Without any other comments, please select the index of the most likely pair for
 
             # ensure lat is first in the pair
             latlon_pairs.append((cur.name, match.name))
+            print(f'LLM identified coordinate pair: {latlon_pairs[-1]}')
             continue
         except Exception as e:
             pdb.set_trace()
             print(e)
 
-    for pair in latlon_pairs:
-        print(f'LLM identified coordinate pair: {pair}')
-
     # mark the pairs in the geo annotations (revalidate each annotation with the new info)
     for c0_name, c1_name in latlon_pairs:
         c0 = geo_annotations[geo_idxs[c0_name]]
@@ -332,32 +659,36 @@ Without any other comments, please select the index of the most likely pair for
         #     })
         # )
 
+    stage('coordinate formats')
     # handling latlon vs lonlat in single coordinate column
-    for col in geo_annotations:
-        if col.geo_type == GeoType.COORDINATES:
-            response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{col.name}" with the following values (first 5 rows):
-{df[col.name].head().to_string()}
+    def get_coord_format(col: GeoAnnotation) -> str:
+        return agent.oneshot_sync('You are a helpful assistant.', f'''\
+I'm looking at a dataset called "{meta.name}".  I have a column called "{col.name}" with the following profile:
+{summaries[col.name]}
 The column has been identified as containing geographic information, and has been marked as containing coordinates.
 I need to determine if these coordinates are Latitude,Longitude, or Longitude,Latitude. Without any other comments, please output one of the following options: "LATLON" or "LONLAT" or "UNSURE" if you are unsure.
 '''
-                                          )
-            if response == 'UNSURE':
-                print(f'LLM was unsure about the coordinate format for column "{col.name}"')
-                continue
-            if response not in ('LATLON', 'LONLAT'):
-                raise ValueError(f'LLM provided invalid coordinate format for column "{col.name}": {response}')
-            coord_format = CoordFormat.LATLON if response == 'LATLON' else CoordFormat.LONLAT
-            inplace_replace(
-                geo_annotations,
-                col,
-                GeoAnnotation(**{
-                    **col.model_dump(),
-                    'coord_format': coord_format
-                })
-            )
-            print(f'LLM identified coordinate column "{col.name}" as having format: "{coord_format.name}"')
+                                  )
+
+    coord_columns = [col for col in geo_annotations if col.geo_type == GeoType.COORDINATES and col.name not in known_annotations]
+    for col, response in zip(coord_columns, map_concurrent(get_coord_format, coord_columns, max_workers)):
+        if response == 'UNSURE':
+            print(f'LLM was unsure about the coordinate format for column "{col.name}"')
+            continue
+        if response not in ('LATLON', 'LONLAT'):
+            raise ValueError(f'LLM provided invalid coordinate format for column "{col.name}": {response}')
+        coord_format = CoordFormat.LATLON if response == 'LATLON' else CoordFormat.LONLAT
+        inplace_replace(
+            geo_annotations,
+            col,
+            GeoAnnotation(**{
+                **col.model_dump(),
+                'coord_format': coord_format
+            })
+        )
+        print(f'LLM identified coordinate column "{col.name}" as having format: "{coord_format.name}"')
 
+    stage('primary geo')
     # identify the primary geo
     geo_candidates_str = latlon_pairs + isolated_geo_columns
 
@@ -406,16 +737,22 @@ Without any other comments, please select the index of the most likely primary g
             pdb.set_trace()
             print(e)
 
+    stage('date grouping')
     # identify date column pairs/groups
-    date_columns: list[str] = []
+    date_parts: dict[str, DateType] = {}
     isolated_date_columns: list[str] = []
     for date in date_annotations:
         if date.date_type == DateType.YEAR or date.date_type == DateType.MONTH or date.date_type == DateType.DAY:
-            date_columns.append(date.name)
+            date_parts[date.name] = date.date_type
         else:
             isolated_date_columns.append(date.name)
 
-    date_groups: list[tuple[str, ...]] = []
+    # group by name similarity and null patterns first. Only ties are left for the llm
+    date_groups, date_columns, ungrouped = group_date_parts(df, date_parts)
+    isolated_date_columns.extend(ungrouped)
+    for group in date_groups:
+        print(f'Pairing scores identified date group: {group}')
+
     while len(date_columns) > 0:
         cur_name = date_columns.pop()
         cur = date_annotations[date_idxs[cur_name]]
@@ -434,14 +771,14 @@ Without any other comments, please select the index of the most likely primary g
 
         # else ask the llm to pick the best matching group if any
         candidate_names = [i.name for i in candidates]
-        candidate_heads = [df[i.name].head().to_string() for i in candidates]
+        candidates_str = '\n'.join([f'{i}: "{c.name}" with profile:\n{summaries[c.name]}' for i, c in enumerate(candidates)])
         response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{cur.name}" with the following values (first 5 rows):
-{df[cur.name].head().to_string()}
+I'm looking at a dataset called "{meta.name}".  I have a column called "{cur.name}" with the following profile:
+{summaries[cur.name]}
 I'm trying to identify the column that should be grouped with this date column. 
 A group may contain 0 or 1 YEAR columns, 0 or 1 MONTH columns, 0 or 1 DAY columns. Groups will typically be identifiable by commonalities in their name
 I have the following candidates:
-{', '.join([ f'{i}:{name} with values {head}' for i, (name, head) in enumerate(zip(candidate_names, candidate_heads))])}
+{candidates_str}
 Without any other comments, please select the index or indices of the most likely the column(s) that pair with "{cur.name}" from the list above, i.e. please output a single integer (0-{len(candidates)-1}), or a comma separated list of integers.
 '''
                                       )
@@ -452,6 +789,7 @@ Without any other comments, please select the index or indices of the most likel
                 raise ValueError(
                     f'LLM provided out of range index for date pair. {response=} out of {candidate_names=}')
             date_groups.append((cur.name, *[candidates[i].name for i in response]))
+            print(f'LLM identified date group: {date_groups[-1]}')
             for i in response:
                 date_columns.remove(candidates[i].name)
             continue
@@ -459,9 +797,6 @@ Without any other comments, please select the index or indices of the most likel
             pdb.set_trace()
             print(e)
 
-    for group in date_groups:
-        print(f'LLM identified date group: {group}')
-
     # mark the groups in the date annotations (revalidate each annotation with the new info)
     for group in date_groups:
         # for date_name in group:
@@ -480,6 +815,7 @@ Without any other comments, please select the index or indices of the most likel
             })
         )
 
+    stage('primary date')
     # identify primary date
     date_candidates_str = date_groups + isolated_date_columns
 
@@ -527,84 +863,162 @@ Without any other comments, please select the index of the most likely primary d
             pdb.set_trace()
             print(e)
 
+    stage('format inference')
     # identify the format string of DateType.DATE columns
-    for date in date_annotations:
-        if date.date_type in (DateType.YEAR, DateType.MONTH, DateType.DAY, DateType.DATE):
-            col = date.name
+    def get_time_format(date: DateAnnotation) -> tuple[str, str]:
+        """
+        Returns (strftime format or UNSURE, who identified it).
+        Candidate formats are tested against the column locally first, and the LLM is only asked if none of them parse it
+        """
+        ranked = rank_strftime_formats(values(date.name), date.date_type.name)
+        best = [fmt for fmt, ratio in ranked if ratio >= MIN_PARSE_RATIO and ratio == ranked[0][1]]
+        best = distinct_interpretations(values(date.name), best)
+        if len(best) > 1 and csv is not None:
+            # the sample fits formats that disagree, but the rest of the column may not
+            column = as_date_strings(csv.column(date.name))
+            best = [fmt for fmt in best if format_parse_ratio(column, fmt) >= MIN_PARSE_RATIO]
+        if len(best) == 1:
+            return best[0], 'Inference'
+
+        if len(best) > 1:
+            # several formats parse the whole column, but disagree on the dates (e.g. day/month order)
             response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{col}" with the following values (first 5 rows):
-{df[col].head().to_string()}
+I'm looking at a dataset called "{meta.name}".  I have a column called "{date.name}" with the following profile:
+{summaries[date.name]}
 The column has been identified as containing date/time information, and has been marked as a {date.date_type.name} column.
-I need to identify the strftime format for this field. Without any other comments, please output a valid strftime format string or UNSURE if you are unsure.
-'''
-                                          )
-            if response == 'UNSURE':
-                print(f'LLM was unsure about the time format for {date.date_type.name} column "{col}"')
-                continue  # TODO: could ask the user here. For now just skip
-
-            # strip any wrapping quotes
-            fmt = response.strip('\'"`')
-
-            # TODO: check if format string is a valid format string
-            assert is_valid_strftime_format(
-                fmt), f'LLM provided invalid strftime format string for {date.date_type.name} column "{col}": {fmt}'
-
-            inplace_replace(
-                date_annotations,
-                date,
-                DateAnnotation(**{
-                    **date.model_dump(),
-                    'time_format': fmt
-                })
-            )
-
-            print(f'LLM identified {date.type.name}/{date.date_type.name} column "{col}" strftime format: "{fmt}"')
-
-    # Come up with descriptions for each annotated column
-    for feature in feature_annotations:
-        response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{feature.name}" with the following values (first 5 rows):
-{df[feature.name].head().to_string()}
-The current annotations for this column are:
-{feature.model_dump()}
-I need a description for this feature column. Please provide a brief description for this column. Do not refer to the column itself in your description, and do not include any other comments, only write the description.
+I need to identify the strftime format for this field. The following formats all parse every value in the column:
+{', '.join([f'{i}:{fmt}' for i, fmt in enumerate(best)])}
+Without any other comments, please select the index of the most likely format from the list above, i.e. please output a single integer (0-{len(best)-1}) with your selection.
 '''
                                       )
+            try:
+                return best[int(response)], 'LLM'
+            except (ValueError, IndexError):
+                return 'UNSURE', 'LLM'
+
+        messages = [
+            Message(Role.system, 'You are a helpful assistant.'),
+            Message(Role.user, f'''\
+I'm looking at a dataset called "{meta.name}".  I have a column called "{date.name}" with the following profile:
+{summaries[date.name]}
+The column has been identified as containing date/time information, and has been marked as a {date.date_type.name} column.
+I need to identify the strftime format for this field. Without any other comments, please output a valid strftime format string or UNSURE if you are unsure.
+'''
+                    )
+        ]
+        response = agent.multishot_sync(messages)
+
+        # reprompt the LLM once if its format doesn't actually parse the data
+        fmt = response.strip('\'"`')
+        if fmt != 'UNSURE' and is_valid_strftime_format(fmt):
+            ratio = format_parse_ratio(as_date_strings(values(date.name)), fmt)
+            if ratio < MIN_PARSE_RATIO:
+                messages.append(Message(Role.assistant, response))
+                messages.append(Message(
+                    Role.system, f'`{fmt}` only parses {ratio:.0%} of the values in the column, e.g. it fails on: {unparsed_values(values(date.name), fmt)}. Without any other comments, please output a corrected strftime format string or UNSURE if you are unsure.'))
+                response = agent.multishot_sync(messages)
+
+        return response, 'LLM'
+
+    formattable_dates = [date for date in date_annotations if date.date_type in (
+        DateType.YEAR, DateType.MONTH, DateType.DAY, DateType.DATE) and date.name not in known_annotations]
+    for date, (response, source) in zip(formattable_dates, map_concurrent(get_time_format, formattable_dates, max_workers)):
+        col = date.name
+        if response == 'UNSURE':
+            print(f'LLM was unsure about the time format for {date.date_type.name} column "{col}"')
+            continue  # TODO: could ask the user here. For now just skip
+
+        # strip any wrapping quotes
+        fmt = response.strip('\'"`')
+
+        assert is_valid_strftime_format(
+            fmt), f'LLM provided invalid strftime format string for {date.date_type.name} column "{col}": {fmt}'
+
+        # verify the format against every value in the column
+        ratio = format_parse_ratio(as_date_strings(values(col)), fmt)
+        if ratio < MIN_PARSE_RATIO:
+            print(f'{source} provided strftime format "{fmt}" for {date.date_type.name} column "{col}", but it only parses {ratio:.0%} of the values (e.g. {unparsed_values(values(col), fmt)}). Skipping')
+            continue  # TODO: could ask the user here. For now just skip
+
+        inplace_replace(
+            date_annotations,
+            date,
+            DateAnnotation(**{
+                **date.model_dump(),
+                'time_format': fmt
+            })
+        )
+
+        print(f'{source} identified {date.type.name}/{date.date_type.name} column "{col}" strftime format: "{fmt}"')
+
+    stage('descriptions')
+    # Come up with units and descriptions for each annotated column, one structured response per column (or batch)
+    def describe(annotations: list[GeoAnnotation | DateAnnotation | FeatureAnnotation], schema: type[BaseModel], request: str) -> dict[str, BaseModel]:
+        batches = [annotations[i:i + (batch_size or 1)] for i in range(0, len(annotations), batch_size or 1)]
+
+        def describe_batch(batch: list[GeoAnnotation | DateAnnotation | FeatureAnnotation]) -> dict[str, BaseModel]:
+            columns_str = '\n'.join([f'"{col.name}" with profile:\n{summaries[col.name]}\nThe current annotations for this column are:\n{col.model_dump()}' for col in batch])
+            return agent.structured([
+                Message(role=Role.system, content='You are a helpful assistant.'),
+                Message(role=Role.user, content=f'''\
+I'm looking at a dataset called "{meta.name}".  I have the following column(s):
+{columns_str}
+{request}\
+'''),
+            ], schema, [col.name for col in batch])
+
+        details = {}
+        for batch_details in map_concurrent(describe_batch, batches, max_workers):
+            details.update(batch_details)
+        for col in annotations:
+            if col.name not in details:
+                print(f'LLM gave no valid {schema.__name__} for column "{col.name}"')
+        return details
+
+    feature_details = describe([a for a in feature_annotations if a.name not in known_annotations], FeatureDetails, 'I need the units (if any), a description of the units, and a description for each feature column.')
+    for feature in [*feature_annotations]:
+        if feature.name not in feature_details:
+            continue
+        details: FeatureDetails = feature_details[feature.name]
+        units, units_description = details.units, details.units_description
+        if units == 'NONE':
+            units, units_description = 'N/A', 'N/A'
+            print(f'LLM identified no units for feature column "{feature.name}"')
+        elif units == 'UNSURE':
+            units, units_description = None, None
+            print(f'LLM was unsure about the units for feature column "{feature.name}"')
+        else:
+            print(f'LLM provided units and description for feature column "{feature.name}": {units}. {units_description}')
         feature_annotations[feature_idxs[feature.name]] = FeatureAnnotation(**{
             **feature.model_dump(),
-            'description': response
+            'units': units,
+            'units_description': units_description,
+            'description': details.description
         })
-        print(f'LLM provided description for feature column "{feature.name}": "{response}"')
+        print(f'LLM provided description for feature column "{feature.name}": "{details.description}"')
 
-    for date in date_annotations:
-        response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{date.name}" with the following values (first 5 rows):
-{df[date.name].head().to_string()}
-The current annotations for this column are:
-{date.model_dump()}
-I need a description for this date column. Please provide a brief description for this column. Do not refer to the column itself in your description, and do not include any other comments, only write the description.
-'''
-                                      )
+    date_details = describe([a for a in date_annotations if a.name not in known_annotations], ColumnDescription, 'I need a description for each date column.')
+    for date in [*date_annotations]:
+        if date.name not in date_details:
+            continue
         date_annotations[date_idxs[date.name]] = DateAnnotation(**{
             **date.model_dump(),
-            'description': response
+            'description': date_details[date.name].description
         })
-        print(f'LLM provided description for date column "{date.name}": "{response}"')
+        print(f'LLM provided description for date column "{date.name}": "{date_details[date.name].description}"')
 
-    for geo in geo_annotations:
-        response = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I'm looking at a dataset called "{meta.name}".  I have a column called "{geo.name}" with the following values (first 5 rows):
-{df[geo.name].head().to_string()}
-I need a description for this geo column. Please provide a brief description for this column. Do not refer to the column itself in your description, and do not include any other comments, only write the description.
-'''
-                                      )
+    geo_details = describe([a for a in geo_annotations if a.name not in known_annotations], ColumnDescription, 'I need a description for each geo column.')
+    for geo in [*geo_annotations]:
+        if geo.name not in geo_details:
+            continue
         geo_annotations[geo_idxs[geo.name]] = GeoAnnotation(**{
             **geo.model_dump(),
-            'description': response
+            'description': geo_details[geo.name].description
         })
-        print(f'LLM provided description for geo column "{geo.name}": "{response}"')
+        print(f'LLM provided description for geo column "{geo.name}": "{geo_details[geo.name].description}"')
 
     # pdb.set_trace()
+    stage.done()
 
     return AnnotationSchema(
         geo=geo_annotations,
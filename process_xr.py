@@ -2,9 +2,19 @@ from __future__ import annotations
 
 from agent import Agent
 from meta import Meta
+import numpy as np
+import pandas as pd
 import xarray as xr
 from typing import TypeVar
-from utils import enum_to_keys, ask_user
+from utils import enum_to_keys, ask_user, map_concurrent
+from process_df import identify_column_type, feature_type_from_dtype
+from date_formats import rank_strftime_formats, MIN_PARSE_RATIO
+from cf import cf_coordinate_type, cf_description, cf_units
+from raster import read_raster_info
+from xr_stats import VariableStats, cached_stats, limit_chunk_cache
+from instrument import StageTimer
+from pathlib import Path
+from glob import glob
 
 
 from MetadataSchema import (
@@ -26,16 +36,363 @@ from MetadataSchema import (
 import pdb
 
 
-def handle_netcdf(meta: Meta, agent: Agent) -> AnnotationSchema:
-    data = xr.open_dataset(meta.path)
-    return handle_dataset(data, meta, agent)
+def handle_netcdf(meta: Meta, agent: Agent, max_workers: int = 1, stats_workers: int = 4, memory_limit: int | str | None = '512MB', stats_cache: str | Path | None = '.stats_cache') -> AnnotationSchema:
+    # chunks={} opens every variable lazily as a dask array using the file's own chunking, so nothing is read up front
+    limit_chunk_cache()
+    data = xr.open_dataset(meta.path, chunks={})
+    try:
+        return handle_dataset_with_stats(meta.path, data, meta, agent, max_workers, stats_workers, memory_limit, stats_cache)
+    finally:
+        data.close()
 
 
-def handle_geotiff(meta: Meta, agent: Agent) -> AnnotationSchema:
-    data = xr.open_rasterio(meta.path)
-    return handle_dataset(data, meta, agent)
+def handle_dataset_with_stats(path: Path | list[Path], data: xr.Dataset, meta: Meta, agent: Agent, max_workers: int = 1, stats_workers: int = 4, memory_limit: int | str | None = '512MB', stats_cache: str | Path | None = '.stats_cache') -> AnnotationSchema:
+    """`handle_dataset`, with whole-variable statistics of the dataset read from the file(s) at path (see `cached_stats`)"""
+    stage = StageTimer(agent.metrics)
+    stage('statistics')
+    stats = cached_stats(path, data, cache_dir=stats_cache, workers=stats_workers, memory_limit=memory_limit)
+    stage.done()
+    return handle_dataset(data, meta, agent, max_workers=max_workers, stats=stats)
 
 
-def handle_dataset(data: xr.Dataset, meta: Meta, agent: Agent) -> AnnotationSchema:
-    pdb.set_trace()
-    return AnnotationSchema()
+def structure_signature(data: xr.Dataset) -> tuple[str, ...]:
+    """The names, dimensions and dtypes of every variable. Files with the same signature can share annotations"""
+    return tuple(f'{name}|{",".join(map(str, var.dims))}|{var.dtype}' for name, var in sorted(data.variables.items()))
+
+
+def handle_netcdf_collection(meta: Meta, agent: Agent, max_workers: int = 1, stats_workers: int = 4, memory_limit: int | str | None = '512MB', stats_cache: str | Path | None = '.stats_cache') -> dict[Path, AnnotationSchema]:
+    """
+    Annotate a collection of NetCDF files (e.g. one file per year or scenario) matching the glob pattern `meta.path`.
+
+    Files are grouped by structure (see `structure_signature`), and each group is opened lazily as one combined
+    dataset with `xr.open_mfdataset` and annotated once. Every file gets a copy of its group's annotations, so the
+    number of LLM calls depends on the number of distinct structures rather than the number of files.
+    Statistics are computed over each group's combined dataset, as in `handle_netcdf`.
+    Returns the annotations per file, in sorted path order.
+    """
+    paths = [Path(path) for path in sorted(glob(str(meta.path)))]
+    if not paths:
+        raise FileNotFoundError(f'No files match {meta.path}')
+
+    limit_chunk_cache()
+    groups: dict[tuple[str, ...], list[Path]] = {}
+    for path in paths:
+        with xr.open_dataset(path, chunks={}) as data:
+            groups.setdefault(structure_signature(data), []).append(path)
+    print(f'Found {len(paths)} files in {len(groups)} structural group(s) matching {meta.path}')
+
+    results: dict[Path, AnnotationSchema] = {}
+    for group in groups.values():
+        try:
+            data = xr.open_mfdataset(group, chunks={}, combine='by_coords')
+            sources = group
+        except ValueError as e:
+            # e.g. files that overlap rather than tile along their coordinates. The first file stands in for the group
+            print(f'Could not combine {len(group)} files ({e}), annotating {group[0]} on behalf of the group')
+            data = xr.open_dataset(group[0], chunks={})
+            sources = group[0]
+        try:
+            annotations = handle_dataset_with_stats(sources, data, meta, agent, max_workers, stats_workers, memory_limit, stats_cache)
+        finally:
+            data.close()
+        for path in group:
+            results[path] = annotations.model_copy(deep=True)
+
+    return {path: results[path] for path in paths}
+
+
+def handle_geotiff(meta: Meta, agent: Agent, max_workers: int = 1) -> AnnotationSchema:
+    """
+    Annotate a GeoTIFF from its header (CRS, transform, band metadata) and bounded per-band statistics.
+    Each band is a feature. For a geographic CRS, the pixel grid's x/y coordinates are the (primary) longitude/latitude.
+    Otherwise (e.g. a projected CRS in meters) they aren't latitudes/longitudes, so they are annotated as features,
+    described with their CRS
+    """
+    stage = StageTimer(agent.metrics)
+    stage('statistics')
+    info = read_raster_info(meta.path)
+    print(f'Read raster header and band statistics ({info.stats_source}) for {meta.path}')
+    summaries = {band.name: f'{info.to_prompt()}\n{band.to_prompt()}' for band in info.bands}
+
+    crs = info.crs or 'an unspecified coordinate reference system'
+    if info.is_geographic:
+        geo_annotations = [
+            GeoAnnotation(
+                name=name,
+                display_name=None,
+                description=f'{axis.capitalize()} of the pixel centers, in {crs}',
+                type=ColumnType.GEO.value,
+                geo_type=geo_type.value,
+                primary_geo=True,
+                resolve_to_gadm=None,
+                is_geo_pair='x' if name == 'y' else None,
+                coord_format=None,
+                qualifies=None,
+                gadm_level=None,
+            )
+            for name, axis, geo_type in (('y', 'latitude', GeoType.LATITUDE), ('x', 'longitude', GeoType.LONGITUDE))
+        ]
+        coordinate_annotations = []
+    else:
+        geo_annotations = []
+        coordinate_annotations = [
+            FeatureAnnotation(
+                name=name,
+                display_name=None,
+                description=f'{axis.capitalize()} of the pixel centers, in {crs} (not latitude/longitude)',
+                type=ColumnType.FEATURE.value,
+                feature_type=FeatureType.FLOAT.value,
+                units=info.crs_units,
+                units_description=None,
+                qualifies=None,
+                qualifierrole=None,
+            )
+            for name, axis in (('y', 'northing'), ('x', 'easting'))
+        ]
+
+    feature_annotations = [
+        FeatureAnnotation(
+            name=band.name,
+            display_name=band.description,
+            description='todo feature description',
+            type=ColumnType.FEATURE.value,
+            feature_type=feature_type_from_dtype(np.dtype(band.dtype)).value,
+            units=band.units,
+            units_description=None,
+            qualifies=None,
+            qualifierrole=None,
+        )
+        for band in info.bands
+    ]
+    stage('units')
+    fill_units(feature_annotations, summaries, meta, agent, max_workers)
+    stage('descriptions')
+    fill_descriptions(feature_annotations, {}, summaries, meta, agent, max_workers)
+    stage.done()
+
+    return AnnotationSchema(
+        geo=geo_annotations,
+        date=[],
+        feature=[*coordinate_annotations, *feature_annotations]
+    )
+
+
+def sample_values(var: xr.Variable, max_values: int = 20) -> np.ndarray:
+    """Read a small block of values from the start of the variable. For chunked variables this touches a single chunk"""
+    if var.ndim == 0:
+        return np.atleast_1d(var.values)
+    per_dim = max(1, int(max_values ** (1 / var.ndim)))
+    return np.asarray(var.isel({dim: slice(0, per_dim) for dim in var.dims}).values).ravel()
+
+
+def _fmt_attr(value, max_len: int = 100) -> str:
+    value = repr(value)
+    return value if len(value) <= max_len else value[:max_len] + '...'
+
+
+def describe_variable(var: xr.Variable) -> str:
+    """Text description of a variable for prompts, built from its metadata plus a small bounded sample of values"""
+    dims = ', '.join(f'{dim} ({size})' for dim, size in var.sizes.items()) or 'none (scalar)'
+    lines = [f'dimensions: {dims}; dtype: {var.dtype}']
+    if var.attrs:
+        lines.append(f'attributes: {", ".join(f"{k}={_fmt_attr(v)}" for k, v in var.attrs.items())}')
+    if var.ndim == 1 and var.size > 0:
+        first, last = var.isel({var.dims[0]: [0, -1]}).values
+        lines.append(f'first value: {first}, last value: {last}')
+    lines.append(f'sample values: {", ".join(str(v) for v in sample_values(var))}')
+    return '\n'.join(lines)
+
+
+def infer_time_format(var: xr.Variable, max_values: int = 1000) -> str | None:
+    """Infer the strftime format of a time coordinate from (at most max_values of) its values"""
+    values = var.isel({var.dims[0]: slice(0, max_values)}).values if var.ndim == 1 else sample_values(var)
+    ranked = rank_strftime_formats(pd.Series(np.asarray(values).ravel()).astype(str), DateType.DATE.name)
+    if ranked and ranked[0][1] >= MIN_PARSE_RATIO:
+        return ranked[0][0]
+    return None
+
+
+def fill_units(features: list[FeatureAnnotation], summaries: dict[str, str], meta: Meta, agent: Agent, max_workers: int = 1):
+    """Ask the LLM for the units of (in place) features that don't have any"""
+    def get_units(feature: FeatureAnnotation) -> str:
+        return agent.oneshot_sync('You are a helpful assistant.', f'''\
+I'm looking at a dataset called "{meta.name}".  I have a variable called "{feature.name}" with the following metadata:
+{summaries[feature.name]}
+I need to identify if this variable has any obvious units (made clear either from the dataset description, variable name, attributes or values).
+Without any other comments, please provide the units for this variable, NONE if units are not relevant, or UNSURE if you are unsure. E.g. if the unit was watts per meter squared, your answer should just be the string W/m^2\
+'''
+                                  )
+
+    missing_units = [feature for feature in features if feature.units is None]
+    for feature, response in zip(missing_units, map_concurrent(get_units, missing_units, max_workers)):
+        if response == 'UNSURE':
+            print(f'LLM was unsure about the units for variable "{feature.name}"')
+            continue
+        units = 'N/A' if response == 'NONE' else response
+        features[features.index(feature)] = FeatureAnnotation(**{**feature.model_dump(), 'units': units})
+        print(f'LLM identified units for variable "{feature.name}": {units}')
+
+
+def fill_descriptions(annotations: list[GeoAnnotation | DateAnnotation | FeatureAnnotation], known: dict[str, str | None], summaries: dict[str, str], meta: Meta, agent: Agent, max_workers: int = 1):
+    """Set (in place) the description of each annotation, asking the LLM for any that aren't already known"""
+    def get_description(annotation: GeoAnnotation | DateAnnotation | FeatureAnnotation) -> str:
+        return agent.oneshot_sync('You are a helpful assistant.', f'''\
+I'm looking at a dataset called "{meta.name}".  I have a variable called "{annotation.name}" with the following metadata:
+{summaries[annotation.name]}
+The current annotations for this variable are:
+{annotation.model_dump()}
+I need a description for this {annotation.type.value} variable. Please provide a brief description for this variable. Do not refer to the variable itself in your description, and do not include any other comments, only write the description.
+'''
+                                  )
+
+    descriptions = {**known}
+    missing = [i for i, annotation in enumerate(annotations) if descriptions.get(annotation.name) is None]
+    for i, response in zip(missing, map_concurrent(get_description, [annotations[i] for i in missing], max_workers)):
+        descriptions[annotations[i].name] = response
+        print(f'LLM provided description for {annotations[i].type.value} variable "{annotations[i].name}": "{response}"')
+    for i, annotation in enumerate(annotations):
+        annotations[i] = annotation.__class__(**{**annotation.model_dump(), 'description': descriptions[annotation.name]})
+
+
+def handle_dataset(data: xr.Dataset, meta: Meta, agent: Agent, max_workers: int = 1, stats: dict[str, VariableStats] | None = None) -> AnnotationSchema:
+    """
+    Annotate a dataset using only its dimensions, coordinates and variable attributes.
+
+    Array values are only read in small bounded samples (see `describe_variable`), so with a lazily opened (dask
+    chunked) dataset, memory use stays flat regardless of the size of the file.
+    Coordinates are classified as geo, date or feature information, and data variables are annotated as features.
+    Coordinates, units and descriptions declared by CF convention attributes (see cf.py) are used as is, so the LLM is
+    only asked about variables whose attributes are missing or non-standard.
+    Precomputed whole-variable `stats` (see xr_stats.py), if given, are added to the variables' prompts.
+    """
+    stage = StageTimer(agent.metrics)
+
+    stage('profiling')
+    summaries = {name: describe_variable(var) for name, var in data.variables.items()}
+    for name, var_stats in (stats or {}).items():
+        summaries[name] += f'\n{var_stats.to_prompt()}'
+    coords = [*data.coords]
+    data_vars = [*data.data_vars]
+
+    def classify(names: list[str], options: list[str], prompt: str) -> list[str | None]:
+        return map_concurrent(lambda name: identify_column_type(agent, summaries[name], name, meta, options, prompt), names, max_workers)
+
+    stage('column typing')
+    # coordinates with CF attributes are identified directly, and only the rest go to the LLM
+    coord_type_map = {col_type.name: [] for col_type in ColumnType}
+    subtype_map: dict[str, str] = {}
+    unknown_coords = []
+    for name in coords:
+        cf_type = cf_coordinate_type(data[name].variable)
+        if cf_type is None:
+            unknown_coords.append(name)
+            continue
+        coord_type, subtype = cf_type
+        coord_type_map[coord_type.name].append(name)
+        if subtype is not None:
+            subtype_map[name] = subtype.name
+        print(f'CF attributes identified coordinate "{name}" as a {coord_type.name}' + (f' ({subtype.name})' if subtype else ''))
+
+    coord_types = classify(
+        unknown_coords,
+        enum_to_keys(ColumnType),
+        'This is a coordinate variable of a gridded (NetCDF) dataset. I need to determine if this coordinate contains geographic information, date/time information, or feature information (e.g. pressure levels or model realizations).'
+    )
+    for name, coord_type in zip(unknown_coords, coord_types):
+        print(f'LLM identified coordinate "{name}" as a {coord_type}')
+        if coord_type is not None:
+            coord_type_map[coord_type].append(name)
+
+    stage('subtypes')
+    unknown_geo = [name for name in coord_type_map['GEO'] if name not in subtype_map]
+    geo_types = classify(
+        unknown_geo,
+        enum_to_keys(GeoType),
+        '''\
+The coordinate has been identified as containing geographic information.
+I need to identify the type of geographic information it contains.\
+'''
+    )
+    for name, geo_type in zip(unknown_geo, geo_types):
+        print(f'LLM identified GEO coordinate "{name}" as a {geo_type}')
+        if geo_type is not None:
+            subtype_map[name] = geo_type
+
+    geo_annotations: list[GeoAnnotation] = []
+    for name in coord_type_map['GEO']:
+        if name in subtype_map:
+            geo_annotations.append(GeoAnnotation(
+                name=name,
+                display_name=None,
+                description=None,
+                type=ColumnType.GEO.value,
+                geo_type=GeoType[subtype_map[name]].value,
+                primary_geo=None,
+                resolve_to_gadm=None,
+                is_geo_pair=None,
+                coord_format=None,
+                qualifies=None,
+                gadm_level=None,
+            ))
+
+    stage('format inference')
+    date_annotations: list[DateAnnotation] = []
+    for name in coord_type_map['DATE']:
+        time_format = infer_time_format(data[name].variable)
+        print(f'Inference identified DATE coordinate "{name}" strftime format: "{time_format}"')
+        date_annotations.append(DateAnnotation(
+            name=name,
+            display_name=None,
+            description=None,
+            type=ColumnType.DATE.value,
+            date_type=DateType.DATE.value,
+            primary_date=None,
+            time_format=time_format or 'todo',
+            associated_columns=None,
+            qualifies=None,
+        ))
+
+    # data variables, plus any non geo/date coordinates, are features. Their type comes straight from the dtype
+    feature_annotations: list[FeatureAnnotation] = []
+    for name in [*coord_type_map['FEATURE'], *data_vars]:
+        var = data[name].variable
+        units = cf_units(var)
+        feature_annotations.append(FeatureAnnotation(
+            name=name,
+            display_name=var.attrs.get('long_name'),
+            description='todo feature description',
+            type=ColumnType.FEATURE.value,
+            feature_type=feature_type_from_dtype(var.dtype).value,
+            units=units,
+            units_description=None,
+            qualifies=None,
+            qualifierrole=None,
+        ))
+
+    stage('geo pairing')
+    # lat/lon coordinates of a grid always go together, and are the primary geo if they're the only pair
+    lats = [geo for geo in geo_annotations if geo.geo_type == GeoType.LATITUDE]
+    lons = [geo for geo in geo_annotations if geo.geo_type == GeoType.LONGITUDE]
+    if len(lats) == 1 and len(lons) == 1:
+        lat, lon = lats[0], lons[0]
+        geo_annotations[geo_annotations.index(lat)] = GeoAnnotation(**{**lat.model_dump(), 'is_geo_pair': lon.name, 'primary_geo': True})
+        geo_annotations[geo_annotations.index(lon)] = GeoAnnotation(**{**lon.model_dump(), 'primary_geo': True})
+        print(f'Identified coordinate pair: {(lat.name, lon.name)}')
+    if len(date_annotations) == 1:
+        date_annotations[0] = DateAnnotation(**{**date_annotations[0].model_dump(), 'primary_date': True})
+
+    # units for features that don't declare them in their attributes, and descriptions for every annotation, taken
+    # from the CF long_name/standard_name where there is one
+    stage('units')
+    fill_units(feature_annotations, summaries, meta, agent, max_workers)
+    stage('descriptions')
+    for annotations in (geo_annotations, date_annotations, feature_annotations):
+        known = {annotation.name: cf_description(data[annotation.name].variable) for annotation in annotations}
+        fill_descriptions(annotations, known, summaries, meta, agent, max_workers)
+    stage.done()
+
+    return AnnotationSchema(
+        geo=geo_annotations,
+        date=date_annotations,
+        feature=feature_annotations
+    )
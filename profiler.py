@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any
+
+import pandas as pd
+
+
+@dataclass
+class ColumnProfile:
+    """Summary statistics of a single column, used as the evidence shown to the LLM in prompts"""
+    name: str
+    dtype: str
+    count: int
+    null_ratio: float
+    n_unique: int
+    min: Any | None
+    max: Any | None
+    top_values: list[tuple[Any, int]]
+    examples: list[Any]
+    _prompt: str | None = field(default=None, repr=False, compare=False)
+
+    def to_prompt(self) -> str:
+        """Text description of the profile for inclusion in a prompt. Only formatted once"""
+        if self._prompt is None:
+            lines = [f'dtype: {self.dtype}, {self.count} non-null values ({self.null_ratio:.1%} null), {self.n_unique} distinct values']
+            if self.min is not None and self.max is not None:
+                lines.append(f'range: {_fmt(self.min)} to {_fmt(self.max)}')
+            if self.top_values and self.n_unique < self.count:
+                lines.append(f'most common: {", ".join(f"{_fmt(v)} ({n})" for v, n in self.top_values)}')
+            lines.append(f'examples: {", ".join(_fmt(v) for v in self.examples) or "none (all values are null)"}')
+            self._prompt = '\n'.join(lines)
+        return self._prompt
+
+
+def _fmt(value: Any, max_len: int = 60) -> str:
+    if isinstance(value, float):
+        return f'{value:.6g}'
+    if isinstance(value, str):
+        if len(value) > max_len:
+            value = value[:max_len] + '...'
+        return repr(value)
+    return str(value)
+
+
+def profile_df(df: pd.DataFrame, top_k: int = 5, n_examples: int = 5) -> dict[str, ColumnProfile]:
+    """
+    Profile every column of the dataframe: dtype, null ratio, cardinality, min/max, top-k values and a few distinct
+    non-null examples. The null counts, cardinalities and ranges are each computed in one pass over the whole frame.
+    """
+    counts = df.count()
+    null_ratios = df.isna().mean() if len(df) else pd.Series(0.0, index=df.columns)
+    n_uniques = df.nunique(dropna=True)
+
+    # min/max only make sense for ordered types
+    ordered = df.select_dtypes(include=['number', 'datetime', 'datetimetz'])
+    ranges = ordered.agg(['min', 'max']) if len(ordered.columns) else None
+
+    profiles: dict[str, ColumnProfile] = {}
+    for col in df.columns:
+        series = df[col]
+        non_null = series.dropna()
+        top = non_null.value_counts().head(top_k)
+        col_min = col_max = None
+        if ranges is not None and col in ranges.columns and counts[col] > 0:
+            col_min, col_max = _to_python(ranges.at['min', col]), _to_python(ranges.at['max', col])
+        profiles[col] = ColumnProfile(
+            name=col,
+            dtype=str(series.dtype),
+            count=int(counts[col]),
+            null_ratio=float(null_ratios[col]),
+            n_unique=int(n_uniques[col]),
+            min=col_min,
+            max=col_max,
+            top_values=[(_to_python(v), int(n)) for v, n in top.items()],
+            examples=[_to_python(v) for v in non_null.drop_duplicates().head(n_examples)],
+        )
+
+    return profiles
+
+
+def _to_python(value: Any) -> Any:
+    """convert numpy scalars to plain python values"""
+    return value.item() if hasattr(value, 'item') and not isinstance(value, pd.Timestamp) else value
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+
+StatsSource = Literal['full', 'overview', 'windows']
+
+
+@dataclass
+class BandInfo:
+    index: int
+    name: str
+    dtype: str
+    nodata: float | None
+    units: str | None
+    description: str | None
+    min: float | None
+    max: float | None
+    mean: float | None
+    nodata_ratio: float
+
+    def to_prompt(self) -> str:
+        lines = [f'band {self.index} of the raster; dtype: {self.dtype}; nodata value: {self.nodata}']
+        if self.description:
+            lines.append(f'band description: {self.description}')
+        if self.units:
+            lines.append(f'units: {self.units}')
+        if self.min is None:
+            lines.append('values: none (all pixels are nodata)')
+        else:
+            lines.append(f'range: {self.min:.6g} to {self.max:.6g}, mean: {self.mean:.6g}, nodata: {self.nodata_ratio:.1%}')
+        return '\n'.join(lines)
+
+
+@dataclass
+class RasterInfo:
+    path: Path
+    crs: str | None
+    is_geographic: bool
+    crs_units: str | None  # linear units of a projected CRS's axes, e.g. metre
+    transform: tuple[float, ...]
+    width: int
+    height: int
+    bounds: tuple[float, float, float, float]
+    bands: list[BandInfo]
+    stats_source: StatsSource
+
+    def to_prompt(self) -> str:
+        left, bottom, right, top = self.bounds
+        return f'{self.width}x{self.height} pixel raster with {len(self.bands)} band(s); CRS: {self.crs}; bounds: x {left:.6g} to {right:.6g}, y {bottom:.6g} to {top:.6g}'
+
+
+def read_raster_info(path: Path, max_pixels: int = 1_000_000, n_windows: int = 8) -> RasterInfo:
+    """
+    Read a raster's metadata from its header, plus per-band statistics computed from at most ~max_pixels pixels.
+
+    Small rasters are read in full. Otherwise the statistics come from the most detailed internal overview that fits in
+    max_pixels, or, if the file has no overviews, from `n_windows` block-aligned windows spread across the raster.
+    Either way memory use is bounded regardless of the size of the file.
+    """
+    with rasterio.open(path) as src:
+        bands = []
+        stats_source: StatsSource = 'full'
+        for i, (dtype, nodata, units, description) in enumerate(zip(src.dtypes, src.nodatavals, src.units, src.descriptions), start=1):
+            values, stats_source = _sample_band(src, i, max_pixels, n_windows)
+            valid = values.compressed()
+            bands.append(BandInfo(
+                index=i,
+                name=description or f'band_{i}',
+                dtype=dtype,
+                nodata=nodata,
+                units=units or None,
+                description=description or None,
+                min=float(valid.min()) if valid.size else None,
+                max=float(valid.max()) if valid.size else None,
+                mean=float(valid.mean()) if valid.size else None,
+                nodata_ratio=1 - valid.size / values.size if values.size else 1.0,
+            ))
+
+        return RasterInfo(
+            path=path,
+            crs=src.crs.to_string() if src.crs else None,
+            is_geographic=bool(src.crs and src.crs.is_geographic),
+            crs_units=src.crs.linear_units if src.crs and src.crs.is_projected else None,
+            transform=tuple(src.transform)[:6],
+            width=src.width,
+            height=src.height,
+            bounds=tuple(src.bounds),
+            bands=bands,
+            stats_source=stats_source,
+        )
+
+
+def _sample_band(src: rasterio.DatasetReader, band: int, max_pixels: int, n_windows: int) -> tuple[np.ma.MaskedArray, StatsSource]:
+    """Read a bounded, masked (nodata excluded) sample of a band's pixels"""
+    if src.width * src.height <= max_pixels:
+        return src.read(band, masked=True), 'full'
+
+    # reading at a reduced shape makes GDAL serve the pixels from the matching overview
+    factors = src.overviews(band)
+    if factors:
+        fits = [f for f in factors if (src.width // f) * (src.height // f) <= max_pixels]
+        factor = min(fits) if fits else max(factors)
+        out_shape = (max(1, src.height // factor), max(1, src.width // factor))
+        return src.read(band, out_shape=out_shape, masked=True), 'overview'
+
+    # no overviews: read a few windows, aligned to the internal blocks so each touches as few blocks as possible
+    block_h, block_w = src.block_shapes[band - 1]
+    per_window = max_pixels // n_windows
+    win_w = min(src.width, max(block_w, int(per_window ** 0.5) // block_w * block_w))
+    win_h = min(src.height, max(block_h, per_window // win_w // block_h * block_h))
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, max(1, (src.height - win_h) // block_h + 1), n_windows) * block_h
+    cols = rng.integers(0, max(1, (src.width - win_w) // block_w + 1), n_windows) * block_w
+    windows = [src.read(band, window=Window(col, row, win_w, win_h), masked=True) for row, col in zip(rows, cols)]
+    return np.ma.concatenate([w.ravel() for w in windows]), 'windows'
@@ -1,4 +1,4 @@
-'''Code|Example|Description
+STRFTIME_CODES_TABLE = '''Code|Example|Description
 %a|Sun|Weekday as locale's abbreviated name.
 %A|Sunday|Weekday as locale's full name.
 %w|0|Weekday as a decimal number, where 0 is Sunday and 6 is Saturday.
@@ -34,4 +34,14 @@
 %%|%|A literal '%' character.'''
 
 
-'''For example 2020-02-01 would have the date format '%Y-%m-%d and February 1, 2020 would be %B %-d, %Y'''
\ No newline at end of file
+STRFTIME_EXAMPLE = '''For example 2020-02-01 would have the date format '%Y-%m-%d and February 1, 2020 would be %B %-d, %Y'''
+
+
+def parse_codes_table() -> dict[str, str]:
+    """map from each strftime code in the table above to its description"""
+    rows = [row.split('|') for row in STRFTIME_CODES_TABLE.splitlines()[1:]]
+    return {code: description for code, example, description in rows}
+
+
+# codes that strptime can parse on every platform (i.e. excluding the platform specific no-padding variants)
+PARSEABLE_CODES = frozenset(code for code, description in parse_codes_table().items() if 'Platform specific' not in description)
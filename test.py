@@ -1,10 +1,15 @@
 from __future__ import annotations
 
-from agent import Agent, set_openai_key
+from agent import Agent, OpenAIBackend, RecordingBackend, ReplayBackend, set_openai_key
+from cache import ResponseCache
+from catalog import annotate_file, run_catalog, serialize
+from fingerprint import AnnotationStore, load_signatures, save_signatures
+from instrument import Metrics
 from meta import Meta, get_meta
-from process_df import handle_csv, handle_xlsx
-from process_xr import handle_netcdf, handle_geotiff
+from process_df import table_signatures
+from MetadataSchema import AnnotationSchema, MetaModel
 
+from pathlib import Path
 import sys
 import pdb
 
@@ -29,68 +34,112 @@ def main():
     meta = get_meta()
     meta = [*meta[:12]]  # debug, look just at the csv/xlsx files
 
-    # shorten the description if necessary
-    agent = Agent(model='gpt-4-turbo-preview', timeout=10.0)
-
-    for m in meta:
-        print(m)
-        if len(m.description) > 1000:
-            m.description = shorten_description(m, agent)
-
-        if m.path.suffix == '.csv':
-            annotations = handle_csv(m, agent)
-        elif m.path.suffix == '.xlsx':
-            annotations = handle_xlsx(m, agent)
-        elif m.path.suffix == '.nc':
-            annotations = handle_netcdf(m, agent)
-        elif m.path.suffix == '.tif' or m.path.suffix == '.tiff':
-            annotations = handle_geotiff(m, agent)
-        else:
-            raise ValueError(f'Unhandled file type: {m.path.suffix}')
-
-        print(annotations)
-        print('\n\n')
-
-
-def shorten_description(meta: Meta, agent: Agent) -> str:
-    desc = agent.oneshot_sync('You are a helpful assistant.', f'''\
-I have a dataset called "{meta.name}" With the following description:
-"""
-{meta.description}
-"""
-I would like to ensure that it is just a simple description purely about the data without any other superfluous information. Things to remove include contact info, bibliographies, URLs, etc. If there is a lot of superfluous information, could you pare it down to just the key details? Output only the new description without any other comments. If there are not superfluous details, output only the original unmodified description.\
-''')
-    return desc
+    # each dataset is annotated in its own process, and written to output/ as soon as it finishes
+    results = run_catalog(
+        meta,
+        Path('output'),
+        processes=4,
+        timeout=600,
+        agent_options={'model': 'gpt-4-turbo-preview', 'timeout': 10.0, 'cache_path': Path('.llm_cache.sqlite')},
+        annotate_options={'max_workers': 8, 'store': AnnotationStore()},
+    )
+    for result in results:
+        print(f'{result.meta.path}: {result.status} ({result.seconds:.1f}s) {result.output or ""}')
+
+
+def load_previous(path: Path) -> tuple[AnnotationSchema | MetaModel, dict[str, str] | None]:
+    """
+    previous annotations, saved either as a bare AnnotationSchema or as a whole MetaModel, and the column signatures
+    saved next to them (e.g. by --output or run_catalog), if any
+    """
+    text = path.read_text()
+    model = MetaModel.model_validate_json(text)
+    annotations = model if model.annotations is not None else AnnotationSchema.model_validate_json(text)
+    return annotations, load_signatures(path)
 
 
 def main2():
     from argparse import ArgumentParser
-    from pathlib import Path
 
     parser = ArgumentParser()
     parser.add_argument('--path', action='store', type=Path)
     parser.add_argument('--name', action='store', type=str)
     parser.add_argument('--description', action='store', type=str)
+    parser.add_argument('--max-workers', action='store', type=int, default=1,
+                        help='number of concurrent LLM calls to make per annotation pass')
+    parser.add_argument('--batch-size', action='store', type=int, default=None,
+                        help='if given, classify this many columns per LLM request')
+    parser.add_argument('--heuristic-threshold', action='store', type=float, default=0.9,
+                        help='minimum confidence for a rule-based column classification to skip the LLM (>1 to disable)')
+    parser.add_argument('--flat-taxonomy', action='store_true',
+                        help='classify each column\'s type and subtype in a single LLM pass (e.g. GEO.LATITUDE)')
+    parser.add_argument('--sample-rows', action='store', type=int, default=10_000,
+                        help='maximum number of rows to read from CSV files (0 to read the whole file)')
+    parser.add_argument('--sampling', action='store', choices=['head', 'reservoir', 'byte_range'], default='head',
+                        help='how to choose which rows of a CSV file to sample')
+    parser.add_argument('--store', action='store', type=Path, default=None,
+                        help='directory of previous annotations to reuse for datasets with a matching schema')
+    parser.add_argument('--previous', action='store', type=Path, default=None,
+                        help='JSON annotations (or MetaModel) from a previous run of this dataset, to only re-annotate changed columns')
+    parser.add_argument('--output', action='store', type=Path, default=None,
+                        help='write the annotations to this JSON file (and the column signatures next to it, for --previous)')
+    parser.add_argument('--cache', action='store', type=Path, default=Path('.llm_cache.sqlite'),
+                        help='path to the on-disk LLM response cache')
+    parser.add_argument('--no-cache', action='store_true', help='always query the LLM, ignoring the response cache')
+    parser.add_argument('--cache-ttl', action='store', type=float, default=None,
+                        help='maximum age in seconds of cached responses')
+    parser.add_argument('--record', action='store', type=Path, default=None,
+                        help='append every LLM request/response (including response cache hits) to this JSONL file')
+    parser.add_argument('--replay', action='store', type=Path, default=None,
+                        help='serve LLM responses from a file written by --record instead of calling the API')
+    parser.add_argument('--metrics', action='store', type=Path, default=None,
+                        help='write a JSON report of per-stage timings and LLM usage to this path')
+    parser.add_argument('--prometheus', action='store', type=Path, default=None,
+                        help='write the per-stage metrics to this path as a Prometheus textfile')
     args = parser.parse_args()
 
     meta = Meta(args.path, args.name, args.description)
 
-    set_openai_key()
-
-    agent = Agent(model='gpt-4-turbo-preview', timeout=10.0)
-
-    if args.path.suffix == '.csv':
-        annotations = handle_csv(meta, agent)
-    elif args.path.suffix == '.xlsx':
-        annotations = handle_xlsx(meta, agent)
-    elif args.path.suffix == '.nc':
-        annotations = handle_netcdf(meta, agent)
-    elif args.path.suffix == '.tif' or args.path.suffix == '.tiff':
-        annotations = handle_geotiff(meta, agent)
-    else:
-        raise ValueError(f'Unhandled file type: {args.path.suffix}')
+    if args.replay is None:
+        set_openai_key()
+
+    cache = None if args.no_cache else ResponseCache(args.cache, ttl=args.cache_ttl)
+    backend = OpenAIBackend(timeout=10.0)
+    if args.replay is not None:
+        backend = ReplayBackend(args.replay)
+    if args.record is not None:
+        backend = RecordingBackend(backend, args.record)
+
+    previous, previous_signatures = load_previous(args.previous) if args.previous is not None else (None, None)
+
+    metrics = Metrics()
+    agent = Agent(model='gpt-4-turbo-preview', timeout=10.0, cache=cache, metrics=metrics, backend=backend)
+
+    annotations = annotate_file(
+        meta, agent,
+        max_workers=args.max_workers,
+        batch_size=args.batch_size,
+        heuristic_threshold=args.heuristic_threshold,
+        flat_taxonomy=args.flat_taxonomy,
+        previous=previous,
+        previous_signatures=previous_signatures,
+        sample_rows=args.sample_rows or None,
+        sampling=args.sampling,
+        store=AnnotationStore(args.store) if args.store is not None else None,
+    )
 
     print(annotations)
+    if args.output is not None:
+        args.output.write_text(serialize(annotations))
+        if meta.path.suffix in ('.csv', '.xlsx'):
+            save_signatures(args.output, table_signatures(meta, args.sample_rows or None, args.sampling))
+    if cache is not None:
+        print(f'LLM response cache: {cache.stats()}')
+    print(f'LLM usage: {metrics.report()["totals"]}')
+    if args.metrics is not None:
+        metrics.write_json(args.metrics, dataset=str(meta.path))
+    if args.prometheus is not None:
+        metrics.write_prometheus(args.prometheus, dataset=str(meta.path))
 
 
 if __name__ == '__main__':
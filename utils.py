@@ -1,13 +1,19 @@
 from __future__ import annotations
 import re
 
-from typing import TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock
+from typing import Callable, Iterable, TypeVar
 
 # Could be more complicated, e.g. use UI to ask user
+_ask_user_lock = Lock()
 
 
 def ask_user(prompt: str) -> str:
-    return input(prompt)
+    # only one worker at a time gets to talk to the user
+    with _ask_user_lock:
+        return input(prompt)
 
 
 def enum_to_keys(enum):
@@ -15,6 +21,7 @@ def enum_to_keys(enum):
 
 
 T = TypeVar('T')
+R = TypeVar('R')
 
 
 def inplace_replace(l: list[T], old: T, new: T):
@@ -23,6 +30,17 @@ def inplace_replace(l: list[T], old: T, new: T):
     l[i] = new
 
 
+def map_concurrent(fn: Callable[[T], R], items: Iterable[T], max_workers: int = 1) -> list[R]:
+    """Apply fn to each item using up to max_workers threads. Results are returned in the same order as items"""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    # each item runs in a copy of the caller's context, so context variables (e.g. the instrumentation stage) carry over
+    contexts = [copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(lambda ctx, item: ctx.run(fn, item), contexts, items))
+
+
 def is_known_strftime_directive(directive):
     known_directives = set([
         "%a", "%A", "%w", "%d", "%b", "%B", "%m", "%y", "%Y", "%H", "%I", "%p", "%M", "%S",
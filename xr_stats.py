@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import dask
+import dask.array as da
+import hashlib
+import json
+import numpy as np
+import xarray as xr
+from dask.utils import parse_bytes
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+
+@dataclass
+class VariableStats:
+    name: str
+    min: float | None
+    max: float | None
+    mean: float | None
+    nan_ratio: float
+    histogram: list[int]
+    bin_edges: list[float]
+
+    def to_prompt(self) -> str:
+        if self.min is None:
+            return 'statistics: none (all values are missing)'
+        lines = [f'range: {self.min:.6g} to {self.max:.6g}, mean: {self.mean:.6g}, missing: {self.nan_ratio:.1%}']
+        if self.histogram:
+            lines.append('histogram: ' + ', '.join(f'[{lo:.3g}, {hi:.3g}): {count}' for lo, hi, count in zip(self.bin_edges, self.bin_edges[1:], self.histogram)))
+        return '\n'.join(lines)
+
+
+def compute_stats(data: xr.Dataset, names: list[str] | None = None, bins: int = 10, workers: int = 4, memory_limit: int | str | None = None) -> dict[str, VariableStats]:
+    """
+    Compute min/max/mean, missing value ratio and a histogram of each numeric variable, without loading whole arrays.
+
+    The reductions run as one dask graph on a thread pool of `workers` threads, and the histograms (which need each
+    variable's range) as a second one, so each chunk is read twice, or once for variables declaring
+    `valid_min`/`valid_max` or `actual_range`. If `memory_limit` is given (bytes, or a string like '2GB'), the variables
+    are processed in groups of at most that many bytes (or one variable, if bigger), and chunks are rechunked so that
+    `workers` of them in flight fit within it. Only each group's results are kept between groups.
+    """
+    names = [name for name in (names if names is not None else data.data_vars) if data[name].dtype.kind in 'biuf']
+    if not names:
+        return {}
+
+    limit = parse_bytes(memory_limit) if memory_limit is not None else None
+    stats = {}
+    for group in _size_groups(data, names, limit):
+        stats.update(_compute_group(data, group, bins, workers, limit // workers if limit is not None else None))
+    return stats
+
+
+def _size_groups(data: xr.Dataset, names: list[str], limit: int | None) -> list[list[str]]:
+    """split names into consecutive groups of variables totalling at most limit bytes (a single variable may exceed it)"""
+    if limit is None:
+        return [names]
+    groups, size = [], 0
+    for name in names:
+        nbytes = data[name].nbytes
+        if not groups or size + nbytes > limit:
+            groups.append([])
+            size = 0
+        groups[-1].append(name)
+        size += nbytes
+    return groups
+
+
+def _compute_group(data: xr.Dataset, names: list[str], bins: int, workers: int, chunk_size: int | None) -> dict[str, VariableStats]:
+    with dask.config.set({'scheduler': 'threads', 'num_workers': workers, **({'array.chunk-size': chunk_size} if chunk_size else {})}):
+        arrays = {name: _as_dask(data[name], chunk_size) for name in names}
+
+        # first pass: reductions
+        reductions = {
+            name: (da.nanmin(arr), da.nanmax(arr), da.nanmean(arr), da.isnan(arr).sum() if arr.dtype.kind == 'f' else 0)
+            for name, arr in arrays.items()
+        }
+        reductions, = dask.compute(reductions)
+
+        # second pass: histograms over each variable's (declared or computed) range
+        ranges = {name: _declared_range(data[name]) or reductions[name][:2] for name in names}
+        histograms = {
+            name: da.histogram(arr, bins=bins, range=tuple(float(v) for v in ranges[name]))
+            for name, arr in arrays.items()
+            if np.isfinite(ranges[name]).all() and ranges[name][0] < ranges[name][1]
+        }
+        histograms, = dask.compute(histograms)
+
+    stats = {}
+    for name in names:
+        lo, hi, mean, n_nan = reductions[name]
+        counts, edges = histograms.get(name, ([], []))
+        size = arrays[name].size
+        all_missing = not np.isfinite(lo)
+        stats[name] = VariableStats(
+            name=name,
+            min=None if all_missing else float(lo),
+            max=None if all_missing else float(hi),
+            mean=None if all_missing else float(mean),
+            nan_ratio=float(n_nan) / size if size else 1.0,
+            histogram=[int(c) for c in counts],
+            bin_edges=[float(e) for e in edges],
+        )
+    return stats
+
+
+def limit_chunk_cache(size: int | str = '4MB'):
+    """
+    Limit the netCDF library's chunk cache to `size` bytes per variable, for files opened from now on (process-wide).
+    The default cache keeps up to 64MB of decompressed chunks of every variable read until the file is closed, so
+    computing stats over a file with many variables would otherwise end up holding most of it in memory
+    """
+    try:
+        import netCDF4
+    except ImportError:
+        return  # other engines don't share the netCDF library's cache
+    _, n_elements, preemption = netCDF4.get_chunk_cache()
+    netCDF4.set_chunk_cache(parse_bytes(size), n_elements, preemption)
+
+
+def _as_dask(var: xr.DataArray, chunk_size: int | None) -> da.Array:
+    if var.chunks is None:
+        # an in-memory variable, e.g. from a dataset opened without chunks
+        return da.from_array(var.values, chunks='auto')
+    arr = var.data
+    # only split chunks that are too big. Merging the file's (smaller) chunks would just hold more in memory at once
+    if chunk_size is not None and np.prod(arr.chunksize) * arr.dtype.itemsize > chunk_size:
+        return arr.rechunk('auto')
+    return arr
+
+
+def _declared_range(var: xr.DataArray) -> tuple[float, float] | None:
+    attrs = var.attrs
+    if 'actual_range' in attrs:
+        declared = attrs['actual_range']
+    elif 'valid_min' in attrs and 'valid_max' in attrs:
+        declared = [*np.ravel(attrs['valid_min']), *np.ravel(attrs['valid_max'])]
+    elif 'valid_range' in attrs:
+        declared = attrs['valid_range']
+    else:
+        return None
+    # malformed attributes (e.g. a scalar actual_range, or text) are ignored, falling back to the computed min/max
+    if np.size(declared) != 2:
+        return None
+    try:
+        lo, hi = (float(v) for v in np.ravel(declared))
+    except (TypeError, ValueError):
+        return None
+    return lo, hi
+
+
+def cached_stats(path: Path | list[Path], data: xr.Dataset, cache_dir: str | Path | None = '.stats_cache', **options) -> dict[str, VariableStats]:
+    """
+    `compute_stats` for the dataset at path (or combined from the files at a list of paths), cached on disk keyed by
+    each file's path, size and modification time (plus the options), so unchanged files are never scanned twice
+    """
+    if cache_dir is None:
+        return compute_stats(data, **options)
+
+    files = []
+    for file in (path if isinstance(path, list) else [path]):
+        stat = file.stat()
+        files.append({'path': str(file.resolve()), 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+    key = json.dumps({**(files[0] if len(files) == 1 else {'files': files}), **options}, sort_keys=True, default=str)
+    cache_path = Path(cache_dir) / f'{hashlib.sha256(key.encode("utf-8")).hexdigest()}.json'
+    if cache_path.exists():
+        return {name: VariableStats(**entry) for name, entry in json.loads(cache_path.read_text()).items()}
+
+    stats = compute_stats(data, **options)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_suffix('.tmp')
+    tmp.write_text(json.dumps({name: asdict(s) for name, s in stats.items()}))
+    tmp.replace(cache_path)
+    return stats